@@ -7,35 +7,163 @@ This solves the problem that we don't want use local code for development and re
 the Puppetfile cannot handle that
 """
 
+# postrun is shipped as this single script
+# pylint: disable=too-many-lines
+
 import argparse
+import asyncio
+import atexit
 import concurrent.futures
+import cProfile
+import contextlib
+import copy
+import fcntl
+import fnmatch
+import hashlib
+import json
 import logging
+import logging.handlers
 import os
+import pstats
+import queue
+import random
+import re
 import shutil
+import socket
+import socketserver
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
 import yaml
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+LOG_QUEUE = queue.Queue()
+LOG_CONTEXT = threading.local()
+LOG_SETUP = {}
+LOG_LOCK = threading.Lock()
+
+
+class ContextFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """
+    Adds the environment and module the logging thread is working on to the records.
+    """
+
+    def filter(self, record):
+
+        for key, value in getattr(LOG_CONTEXT, 'fields', {}).items():
+            setattr(record, key, value)
+
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as JSON lines, with the environment and module if known.
+    """
+
+    def format(self, record):
+
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'message': record.getMessage(),
+                 'thread': record.threadName}
+
+        for field, attribute in (('environment', 'environment'), ('module', 'module_name')):
+            if getattr(record, attribute, None) is not None:
+                entry[field] = getattr(record, attribute)
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, sort_keys=True)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records for the listener thread.
+    Unlike QueueHandler, the traceback is kept apart from the message, as exc_text,
+    so the JSON lines can write it as field of its own.
+    """
+
+    def prepare(self, record):
+
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+
+        # Arguments and tracebacks may not survive being passed to another thread
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+
+        return record
+
+
+@contextlib.contextmanager
+def log_context(environment=None, module=None):
+    """
+    Context manager that adds the environment and module to the records logged by the current thread.
+    """
+
+    previous = getattr(LOG_CONTEXT, 'fields', {})
+    LOG_CONTEXT.fields = dict(previous)
+    if environment is not None:
+        LOG_CONTEXT.fields['environment'] = str(environment)
+    if module is not None:
+        LOG_CONTEXT.fields['module_name'] = str(module)
+
+    try:
+        yield
+    finally:
+        LOG_CONTEXT.fields = previous
+
 
 def create_logger(log_format='%(asctime)s [%(levelname)s]: %(message)s',
                   log_file='/var/log/postrun.log',
-                  verbose=False):
+                  verbose=False,
+                  json_lines=False):
     """
-    Settings for the logging. Logs are printed to stdout and into a file.
+    Settings for the logging. Logs are printed to stdout and into a file, optionally as JSON lines.
+    The records are queued and written by a background thread, so logging never blocks the workers.
+    Calling it again with the same settings doesn't add handlers.
     Returns the logger objects.
     """
 
     log = logging.getLogger(__name__)
-    formatter = logging.Formatter(log_format)
+    config = (log_format, log_file, json_lines)
+
+    with LOG_LOCK:
+        if LOG_SETUP.get('config') != config:
+            stop_logging()
 
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    stdout_handler.setFormatter(formatter)
+            formatter = logging.Formatter(log_format)
 
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setFormatter(formatter)
+            stdout_handler = logging.StreamHandler(sys.stdout)
+            stdout_handler.setFormatter(formatter)
 
-    log.addHandler(stdout_handler)
-    log.addHandler(file_handler)
+            file_handler = logging.FileHandler(log_file)
+            file_handler.setFormatter(JsonFormatter() if json_lines else formatter)
+
+            queue_handler = LogQueueHandler(LOG_QUEUE)
+            queue_handler.addFilter(ContextFilter())
+
+            listener = logging.handlers.QueueListener(LOG_QUEUE, stdout_handler, file_handler)
+            listener.start()
+
+            log.addHandler(queue_handler)
+            LOG_SETUP.update(config=config, listener=listener, handler=queue_handler)
 
     if verbose:
         log.setLevel(logging.DEBUG)
@@ -43,6 +171,36 @@ def create_logger(log_format='%(asctime)s [%(levelname)s]: %(message)s',
     return log
 
 
+def flush_logs():
+    """
+    Waits until all queued records are written.
+    """
+
+    if LOG_SETUP.get('listener'):
+        LOG_QUEUE.join()
+
+
+def stop_logging():
+    """
+    Writes the queued records and removes the handlers. Runs at exit.
+    """
+
+    listener = LOG_SETUP.pop('listener', None)
+    if listener:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+    handler = LOG_SETUP.pop('handler', None)
+    if handler:
+        logging.getLogger(__name__).removeHandler(handler)
+
+    LOG_SETUP.pop('config', None)
+
+
+atexit.register(stop_logging)
+
+
 def commandline(args):
     """
     Settings for the commandline arguments.
@@ -55,12 +213,123 @@ def commandline(args):
                         help="Increase output verbosity",
                         action="store_true")
 
+    parser.add_argument("--log-file",
+                        help="Path of the log file. Default: /var/log/postrun.log",
+                        default="/var/log/postrun.log")
+
+    parser.add_argument("--log-json",
+                        help="Write the log file as JSON lines, with the environment and module of each message",
+                        action="store_true")
+
     parser.add_argument("-m", "--module",
                         help="Name of the module to deploy. Example: vision_foobar")
 
     parser.add_argument("-b", "--branch",
                         help="Branch to deploy for a single module")
 
+    parser.add_argument("--changed-repo",
+                        help="Only deploy the modules of all environments using this repository, optionally at a ref "
+                             "(URL[@ref]). Can be given multiple times, - reads one per line from stdin",
+                        action="append",
+                        default=[])
+
+    parser.add_argument("-j", "--jobs",
+                        help="Number of modules to deploy in parallel",
+                        type=int,
+                        default=10)
+
+    parser.add_argument("--host-jobs",
+                        help="Maximum number of parallel git operations per remote host",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--stall-timeout",
+                        help="Seconds after which a git process without any progress is aborted. Default: 30",
+                        type=int,
+                        default=30)
+
+    parser.add_argument("--retries",
+                        help="Number of retries of git operations failing with a transient error. Default: 2",
+                        type=int,
+                        default=2)
+
+    parser.add_argument("--retry-backoff",
+                        help="Base of the jittered exponential backoff between retries in seconds. Default: 1",
+                        type=float,
+                        default=1.0)
+
+    parser.add_argument("--host-failures",
+                        help="Transient failures after which the remaining modules of a host fail fast. "
+                             "0 disables it. Default: 5",
+                        type=int,
+                        default=5)
+
+    parser.add_argument("-i", "--incremental",
+                        help="Update existing checkouts in place instead of cloning them again",
+                        action="store_true")
+
+    parser.add_argument("--cache-dir",
+                        help="Directory for persistent caches. Default: /var/cache/postrun",
+                        default='/var/cache/postrun')
+
+    parser.add_argument("--mirror",
+                        help="Clone from local bare mirrors in the cache directory, fetched once per run",
+                        action="store_true")
+
+    parser.add_argument("-f", "--force",
+                        help="Deploy all modules, even if the state says they are unchanged",
+                        action="store_true")
+
+    parser.add_argument("-e", "--environment",
+                        help="Only deploy environments matching this name or glob pattern. Can be repeated",
+                        action="append",
+                        default=[])
+
+    parser.add_argument("-l", "--location",
+                        help="Location to deploy. Default: POSTRUN_LOCATION, the cached or the looked up location fact")
+
+    parser.add_argument("--location-ttl",
+                        help="Seconds the looked up location is cached. Default: 3600",
+                        type=int,
+                        default=3600)
+
+    parser.add_argument("--metrics-json",
+                        help="Write timings and outcomes per phase, environment and module as JSON to this file")
+
+    parser.add_argument("--metrics-textfile",
+                        help="Write metrics in the Prometheus text format to this file, for the node_exporter textfile collector")
+
+    parser.add_argument("--partial-clone",
+                        help="Use blobless partial clones. Per module with the partial key in modules.yaml",
+                        action="store_true")
+
+    parser.add_argument("--sparse",
+                        help="Only check out the paths Puppet reads. Per module with the sparse key in modules.yaml",
+                        action="store_true")
+
+    parser.add_argument("--store",
+                        help="Check out every commit once into this content addressed store and link the modules to it")
+
+    parser.add_argument("--store-budget",
+                        help="Size in MiB up to which unreferenced checkouts are kept in the store. Default: 0",
+                        type=int,
+                        default=0)
+
+    parser.add_argument("--profile",
+                        help="Write a Chrome trace of all stages and worker threads to this file")
+
+    parser.add_argument("--profile-stats",
+                        help="Together with --profile, write merged cProfile stats of all threads to this file")
+
+    parser.add_argument("--daemon",
+                        help="Keep running and serve deploy requests on the socket",
+                        action="store_true")
+
+    parser.add_argument("--socket",
+                        help="Unix socket of the daemon. Runs are sent to a daemon listening on it. "
+                             "Default: /run/postrun.sock, empty to always run locally",
+                        default="/run/postrun.sock")
+
     parser.set_defaults(verbose=False)
 
     return parser.parse_args(args)
@@ -86,260 +355,2613 @@ def rmdir(directory):
             shutil.rmtree(directory)
 
 
-def git(*args):
+def swap_directory(new, target, trash_directory, discard=None):
     """
-    Subprocess wrapper for git
-    A timeout is set to terminate the process if to response is received.
-    For example when the git link is wrong.
+    Moves the new directory into place of target.
+    The old target is renamed into the trash directory first and removed after the swap,
+    or moved back if the swap fails. All paths must be on the same filesystem,
+    so target is only missing for the instant between the two renames.
+    With discard the old target is handed to it instead of being removed right away.
     """
 
-    return subprocess.check_call(['git'] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
+    mkdir(trash_directory)
+    trash = tempfile.mkdtemp(dir=trash_directory)
+    old = os.path.join(trash, os.path.basename(target))
 
+    try:
+        if os.path.lexists(target):
+            os.rename(target, old)
 
-def clone_module(module, target_directory, logger):
+        try:
+            os.rename(new, target)
+        except OSError:
+            if os.path.lexists(old):
+                os.rename(old, target)
+            raise
+    finally:
+        if discard and os.path.lexists(old):
+            discard(old)
+        rmdir(trash)
+
+
+def link_directory(source, target, trash_directory, discard=None):
     """
-    Clones a git repository.
-    Used to get each module.
+    Points target to source with a symlink.
+    An existing symlink is replaced atomically, an existing directory is swapped out.
     """
 
-    name, values = module
-    url = values['url']
-    ref = values['ref']
-    target = os.path.join(target_directory, name)
+    mkdir(trash_directory)
+    tmp_link = os.path.join(tempfile.mkdtemp(dir=trash_directory), os.path.basename(target))
 
     try:
-        git('clone', '--depth', '1', url, '-b', ref, target)
-    except subprocess.CalledProcessError as exp:
-        logger.error('Error while cloning {0}'.format(name))
-        logger.debug(exp)
-    except RuntimeError as exp:
-        logger.error('Error while cloning {0}'.format(name))
-        logger.debug(exp)
-
-
-def is_vagrant():
-    """
-    Checks if the current machine runs vagrant.
-    """
+        os.symlink(source, tmp_link)
 
-    return os.path.exists('/vagrant')
+        if os.path.islink(target) or not os.path.lexists(target):
+            os.replace(tmp_link, target)
+        else:
+            swap_directory(tmp_link, target, trash_directory, discard=discard)
+    finally:
+        rmdir(os.path.dirname(tmp_link))
 
 
-def get_location():
+class Trash():
     """
-    Gets the current location fact for this machine.
-    Returns default if nothing is found.
+    Deletes directories in a background thread, so deleting big trees doesn't hold up the deployment.
+    Directories are renamed into the trash directory first, which is instant on the same filesystem.
+    Leftovers of an interrupted run are deleted by the next one.
     """
 
-    location = 'default'
+    def __init__(self, directory):
 
-    try:
-        cmd = ['/opt/puppetlabs/bin/facter', 'location']
-        proc = subprocess.check_output(cmd)
-        location = proc.decode("utf-8").rstrip('\n')
-    except subprocess.CalledProcessError:
-        # TODO: Add logging for this
-        pass
+        self.directory = str(directory)
+        self.pending = False
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()
 
-    return location
+    def discard(self, path):
+        """
+        Moves the path into the trash and deletes it in the background.
+        """
 
+        mkdir(self.directory)
+        os.rename(path, os.path.join(self.directory, '{0}.{1}'.format(os.path.basename(path), uuid.uuid4().hex)))
+        self.empty()
 
-class ModuleLoader():
-    """
-    Loads the modules.yaml and returns the modules as dictionary.
-    """
+    def empty(self):
+        """
+        Deletes the content of the trash in the background.
+        """
 
-    def __init__(self,
-                 dir_path,
-                 logger,
-                 environment='production',
-                 location='default',
-                 module=None,
-                 branch=None):
+        with self.lock:
+            self.pending = True
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.delete, name='postrun-trash')
+            self.thread.start()
 
-        self.requested_module = module
-        self.requested_branch = branch
-        self.logger = logger
-        self.directory = str(dir_path)
-        self.environment = str(environment)
-        self.location = str(location)
-        self.modules_file_path = os.path.join(dir_path, environment, 'modules.yaml')
+    def delete(self):
+        """
+        Deletes the content of the trash until nothing new was discarded.
+        Runs in the background thread.
+        """
 
-        self.modules = {}
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.running = False
+                    return
+                self.pending = False
 
-    def load_modules_file(self):
+            try:
+                with os.scandir(self.directory) as entries:
+                    paths = [entry.path for entry in entries]
+            except FileNotFoundError:
+                paths = []
+
+            for path in paths:
+                if os.path.islink(path) or not os.path.isdir(path):
+                    with contextlib.suppress(OSError):
+                        os.remove(path)
+                else:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def wait(self):
         """
-        Load the modules from the modules file
+        Waits until the trash is empty.
         """
 
-        if not os.path.isfile(self.modules_file_path):
-            self.logger.error('{1} not found for {0}'.format(self.environment, self.modules_file_path))
-            return {}
+        if self.thread:
+            self.thread.join()
 
-        with open(self.modules_file_path, 'r') as yaml_file:
-            parsed_yaml = yaml.load(yaml_file)
 
-        return parsed_yaml
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """
+    Context manager that holds a flock on the file, shared with other postrun processes.
+    The lock is exclusive unless shared is set.
+    """
 
-    def load_modules_from_yaml(self):
-        """
-        Get modules for the specified location
-        """
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
 
-        modules = {}
-        yaml = self.load_modules_file()
 
-        # pylint: disable=lost-exception
-        try:
-            locations = yaml['modules']
-            modules = locations[self.location]
-        except KeyError:
-            self.logger.info('configuration for location %s not found, using default', self.location)
-            modules = locations['default']
-        finally:
-            return modules
+def read_json(path, default=None):
+    """
+    Reads a JSON file.
+    Returns the default if the file is missing or broken.
+    """
 
-    def get_modules(self):
-        """
-        Returns the modules as a dictionary
-        """
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return default
 
-        modules = self.load_modules_from_yaml()
 
-        if self.requested_module:
+def write_json(path, data):
+    """
+    Writes a JSON file atomically.
+    The data is written to a temporary file first, which then replaces the target.
+    """
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(handle, 'w') as json_file:
+            json.dump(data, json_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def directory_size(directory):
+    """
+    Returns the size of all files below a directory in bytes.
+    Missing directories have a size of 0.
+    """
+
+    size = 0
 
+    for root, _, files in os.walk(directory):
+        for name in files:
             try:
-                module = modules[self.requested_module]
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
 
-                if self.requested_branch:
-                    module['ref'] = self.requested_branch
+    return size
 
-                modules = {self.requested_module: module}
 
-            except KeyError:
-                self.logger.error('Module %s not found in configuration', self.requested_module)
-                modules = {}
+def prometheus_labels(**labels):
+    """
+    Formats labels for the Prometheus text format.
+    """
 
-        return modules
+    escaped = ('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in sorted(labels.items()))
 
+    return '{' + ','.join(escaped) + '}'
 
-class ModuleDeployer():
+
+class Metrics():
     """
-    Deployes the passed modules for Vagrant or on a real machine.
+    Collects timings and outcomes per phase, environment and module of a run.
+    A module deployed again in a follow-up pass is reported with its last deployment.
+    Written as JSON report or as node_exporter textfile collector file.
     """
 
-    def __init__(self,
-                 dir_path,
-                 logger,
-                 modules,
-                 is_vagrant,
-                 hiera_path='/etc/puppetlabs/code/hieradata',
-                 opt_path='/opt/puppet/modules',
-                 environment='production'):
+    def __init__(self):
 
-        self.logger = logger
-        self.modules = modules
-        self.directory = str(dir_path)
-        self.is_vagrant = is_vagrant
-        self.opt_path = opt_path
-        self.environment = environment
-        self.hiera_path = os.path.join(hiera_path, environment)
-        self.hiera_opt = '/opt/puppet/hiera'
+        self.started = time.time()
+        self.phases = {}
+        self.environments = {}
+        self.modules = {}
+        self.lock = threading.Lock()
 
-    def has_opt_module(self, module_name):
+    @contextlib.contextmanager
+    def phase(self, name):
         """
-        Checks if there is there is a module in /opt.
-        Both with dashes and underscores in the name.
-        Returns a boolean and the delimiter of the module folders
+        Context manager that adds the time spent inside to a phase.
         """
 
-        module_path_dash = os.path.join(self.opt_path, module_name.replace('_', '-'))
-        module_path_underscore = os.path.join(self.opt_path, module_name)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - started
 
-        is_path = os.path.exists(module_path_dash) or os.path.exists(module_path_underscore)
-        delimiter = '_' if os.path.exists(module_path_underscore) else '-'
+    def start_environment(self, environment):
+        """
+        Marks the start of the deployment of an environment.
+        """
 
-        return (is_path, delimiter)
+        with self.lock:
+            self.environments[environment] = {'started': time.time(), 'finished': time.time(), 'outcome': 'running'}
 
-    def deploy_hiera(self):
+    def finish_environment(self, environment, outcome):
         """
-        Removes and sets the symlink for the Hiera data in Vagrant.
+        Records the outcome of an environment.
+        Its duration reaches from the start to the last finished module.
         """
 
-        rmdir(self.hiera_path)
-        os.symlink(self.hiera_opt, self.hiera_path)
+        with self.lock:
+            entry = self.environments.setdefault(environment, {'started': time.time(), 'finished': time.time()})
+            entry['outcome'] = outcome
 
-    def deploy_local(self, module_name, delimiter):
+    def record_module(self, environment, module, url, duration, size, retries, outcome):
         """
-        Uses /opt symlinks to deploy this module.
+        Records the deployment of a module.
         """
 
-        src = os.path.join(self.opt_path, module_name.replace('_', delimiter))
-        dst = os.path.join(self.directory, module_name)
-        os.symlink(src, dst)
+        with self.lock:
+            self.modules[(environment, module)] = {'environment': environment,
+                                                   'module': module,
+                                                   'url': url,
+                                                   'duration': round(duration, 3),
+                                                   'bytes': size,
+                                                   'retries': retries,
+                                                   'outcome': outcome}
+            if environment in self.environments:
+                self.environments[environment]['finished'] = max(self.environments[environment]['finished'],
+                                                                 time.time())
+
+    def report(self, success=None):
+        """
+        Returns the collected metrics as dictionary.
+        """
 
-    def validate_deployment(self):
+        with self.lock:
+            environments = {name: {'duration': round(entry['finished'] - entry['started'], 3),
+                                   'outcome': entry['outcome']}
+                            for name, entry in self.environments.items()}
+
+            return {'started': self.started,
+                    'duration': round(time.time() - self.started, 3),
+                    'success': success,
+                    'phases': {name: round(duration, 3) for name, duration in self.phases.items()},
+                    'environments': environments,
+                    'modules': list(self.modules.values())}
+
+    def write_json(self, path, success=None):
         """
-        Validate if all modules are deployed correctly
+        Writes the JSON report.
         """
 
-        deployment_ok = True
+        write_json(path, self.report(success))
 
-        for module in self.modules.items():
-            module_name = str(module[0])
-            module_git_dir = os.path.join(self.directory, module_name, '.git')
+    def write_textfile(self, path, success=None):
+        """
+        Writes the metrics in the Prometheus text format for the node_exporter textfile collector.
+        The file is replaced atomically, so the collector never reads a partial file.
+        """
 
-            if not os.path.isdir(module_git_dir):
-                deployment_ok = False
-                self.logger.error('%s not deployed', module_name)
+        report = self.report(success)
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP postrun_{0} {1}'.format(name, help_text))
+            lines.append('# TYPE postrun_{0} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('postrun_{0}{1} {2}'.format(name, prometheus_labels(**labels) if labels else '', value))
+
+        metric('last_run_timestamp_seconds', 'Start of the last postrun run', [({}, report['started'])])
+        metric('run_duration_seconds', 'Duration of the last postrun run', [({}, report['duration'])])
+        metric('success', 'Whether the last postrun run succeeded', [({}, int(bool(success)))])
+        metric('phase_duration_seconds', 'Time spent per phase',
+               [({'phase': name}, value) for name, value in sorted(report['phases'].items())])
+        metric('environment_duration_seconds', 'Deployment duration per environment',
+               [({'environment': name}, entry['duration']) for name, entry in sorted(report['environments'].items())])
+        metric('environment_success', 'Whether the environment was deployed',
+               [({'environment': name}, int(entry['outcome'] in ('ok', 'skipped')))
+                for name, entry in sorted(report['environments'].items())])
+
+        module_labels = [({'environment': entry['environment'], 'module': entry['module']}, entry)
+                         for entry in report['modules']]
+        metric('module_duration_seconds', 'Deployment duration per module',
+               [(labels, entry['duration']) for labels, entry in module_labels])
+        metric('module_bytes', 'Bytes transferred per module',
+               [(labels, entry['bytes']) for labels, entry in module_labels])
+        metric('module_retries', 'Retries per module',
+               [(labels, entry['retries']) for labels, entry in module_labels])
+        metric('module_success', 'Whether the module was deployed',
+               [(labels, int(entry['outcome'] != 'failed')) for labels, entry in module_labels])
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+        with os.fdopen(handle, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+class Tracer():
+    """
+    Records nested spans of the run, including the thread they ran in,
+    and writes them as Chrome trace events (viewable in chrome://tracing or Perfetto).
+    Optionally every traced thread also runs under cProfile, as far as the interpreter allows.
+    A disabled tracer records nothing.
+    """
 
-        return deployment_ok
+    def __init__(self):
 
-    def deploy_modules(self):
+        self.enabled = False
+        self.profiling = False
+        self.origin = time.perf_counter()
+        self.events = []
+        self.threads = {}
+        self.profiles = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def enable(self, profiling=False):
         """
-        Loads the modules from either git or sets local symlinks
+        Starts recording spans and, if requested, cProfile stats.
         """
 
-        # Disabled since we switched to g10k
-        # Problem is, that g10k does a shallow clone an removes the .git directory in the hiera repo
-        # if self.is_vagrant:
-        #     self.deploy_hiera()
+        self.enabled = True
+        self.profiling = self.profiling or profiling
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """
+        Context manager that records a span with the given name and arguments.
+        The outermost span of a thread runs under cProfile when profiling.
+        """
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            for module in self.modules.items():
-                module_name = str(module[0])
-                module_branch = str(module[1]['ref'])
-                module_dir = os.path.join(self.directory, module_name)
-                has_opt_path, delimiter = self.has_opt_module(module_name)
+        if not self.enabled:
+            yield
+            return
 
-                rmdir(module_dir)
-                self.logger.debug('Removed {0}'.format(module_dir))
+        profile = None
+        if self.profiling and not getattr(self.local, 'profile', None):
+            profile = self.local.profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Since Python 3.12 only one thread at a time can run under cProfile,
+                # the others are traced without stats
+                profile = self.local.profile = None
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            finished = time.perf_counter()
+            thread = threading.current_thread()
+
+            if profile:
+                profile.disable()
+                self.local.profile = None
+
+            with self.lock:
+                self.threads[thread.ident] = thread.name
+                self.events.append({'name': name,
+                                    'cat': 'postrun',
+                                    'ph': 'X',
+                                    'ts': round((started - self.origin) * 1e6, 1),
+                                    'dur': round((finished - started) * 1e6, 1),
+                                    'pid': os.getpid(),
+                                    'tid': thread.ident,
+                                    'args': {key: str(value) for key, value in args.items()}})
+                if profile:
+                    self.profiles.append(profile)
+
+    def write(self, path, stats_path=None):
+        """
+        Writes the trace events and, if given, the merged cProfile stats.
+        """
 
-                if self.is_vagrant and has_opt_path:
-                    self.logger.debug('Deploying local {0}'.format(module_name))
-                    self.deploy_local(module_name, delimiter)
-                    # Continue loop since already deployed local
-                    continue
+        with self.lock:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident, 'args': {'name': name}}
+                     for ident, name in self.threads.items()]
+            write_json(path, {'traceEvents': names + self.events, 'displayTimeUnit': 'ms'})
 
-                self.logger.debug('Deploying git {0} with branch {1}'.format(module_name, module_branch))
-                executor.submit(clone_module(module, self.directory, self.logger))
+            if stats_path and self.profiles:
+                pstats.Stats(*self.profiles).dump_stats(stats_path)
 
-            executor.shutdown(wait=True)
 
+TRACER = Tracer()
 
-def main(args,
-         is_vagrant=False,
-         location='default',
-         puppet_base='/etc/puppetlabs/code/environments/',
-         hiera_base='/etc/puppetlabs/code/hieradata'):
+
+class GitRunner():
     """
-    Where the magic happens.
+    Runs git processes on an asyncio event loop in a background thread,
+    so one loop drives all git processes of the worker threads.
+    The output is streamed and a process is only killed once it made no progress,
+    i.e. wrote nothing, for the stall timeout. Large clones keep running as long as data arrives,
+    while hung connections are released as soon as the stall timeout passed.
     """
 
-    module = args.module
-    branch = args.branch
-    logger = create_logger(verbose=args.verbose)
-    deployment_ok = []
+    def __init__(self, stall_timeout=30):
+
+        self.stall_timeout = stall_timeout
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def event_loop(self):
+        """
+        Returns the event loop, started on first use.
+        """
+
+        with self.lock:
+            if not self.loop:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='postrun-git', daemon=True).start()
+
+        return self.loop
+
+    def run(self, cmd, stall_timeout=None):
+        """
+        Runs the command and returns its stdout.
+        Raises CalledProcessError if it fails and TimeoutExpired if it stalls.
+        Blocks the calling thread, not the event loop.
+        """
+
+        future = asyncio.run_coroutine_threadsafe(self.communicate(cmd, stall_timeout or self.stall_timeout),
+                                                  self.event_loop())
+        return future.result()
+
+    async def communicate(self, cmd, stall_timeout):
+        """
+        Coroutine running the process and watching its progress.
+        """
+
+        loop = asyncio.get_running_loop()
+        process = await asyncio.create_subprocess_exec(*cmd,
+                                                       stdin=asyncio.subprocess.DEVNULL,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+        output = {process.stdout: [], process.stderr: []}
+        last_progress = [loop.time()]
+
+        async def drain(stream):
+            while True:
+                chunk = await stream.read(65536)
+                if not chunk:
+                    return
+                output[stream].append(chunk)
+                last_progress[0] = loop.time()
+
+        readers = asyncio.gather(drain(process.stdout), drain(process.stderr))
+
+        while not readers.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(readers),
+                                       timeout=max(last_progress[0] + stall_timeout - loop.time(), 0))
+            except asyncio.TimeoutError:
+                if loop.time() - last_progress[0] >= stall_timeout:
+                    process.kill()
+                    await process.wait()
+                    readers.cancel()
+                    raise subprocess.TimeoutExpired(cmd, stall_timeout,
+                                                    output=b''.join(output[process.stdout]),
+                                                    stderr=b''.join(output[process.stderr])) from None
+
+        stdout = b''.join(output[process.stdout])
+        stderr = b''.join(output[process.stderr])
+
+        if await process.wait():
+            raise subprocess.CalledProcessError(process.returncode, cmd, output=stdout, stderr=stderr)
+
+        return stdout
+
+
+GIT_RUNNER = GitRunner()
+
+
+def git(*args):
+    """
+    Wrapper for git
+    The process is terminated if it makes no progress for the stall timeout.
+    For example when the git link is wrong.
+    """
+
+    GIT_RUNNER.run(['git'] + list(args))
+
+
+def git_output(*args):
+    """
+    Wrapper for git that returns the stripped stdout.
+    Uses the same stall timeout as git().
+    """
+
+    return GIT_RUNNER.run(['git'] + list(args)).decode('utf-8').strip()
+
+
+def git_clone(target, *args):
+    """
+    Wrapper for git clone into target.
+    Removes what an earlier attempt left in target, e.g. a clone killed by the stall timeout,
+    so each attempt starts clean.
+    """
+
+    rmdir(target)
+    git('clone', *args, target)
+
+
+SHA_PATTERN = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
+
+# Paths Puppet reads from a module. Files in the module root (metadata.json, hiera.yaml) are always checked out.
+PUPPET_PATHS = ['manifests', 'templates', 'files', 'lib', 'types', 'functions', 'data', 'facts.d', 'tasks', 'plans']
+
+
+def checkout_options(values, blobless=False, sparse=False):
+    """
+    Returns if a module is cloned blobless and the paths of its sparse checkout (None for a full checkout).
+    The partial and sparse keys of the module override the global options.
+    """
+
+    sparse_paths = values.get('sparse', sparse)
+    if sparse_paths is True:
+        sparse_paths = PUPPET_PATHS
+
+    return bool(values.get('partial', blobless)), [str(path) for path in sparse_paths] if sparse_paths else None
+
+
+def clone_module(module, target_directory, logger, source=None, blobless=False, sparse=False):
+    """
+    Clones a git repository.
+    Used to get each module.
+    If a source (e.g. a local mirror) is given, the module is cloned from there
+    and origin is pointed back to the configured URL afterwards.
+    A blobless partial clone and a sparse checkout can be enabled globally or with the
+    partial and sparse keys of the module. Sparse may be a list of paths, default are the PUPPET_PATHS.
+    """
+
+    name, values = module
+    url = values['url']
+    ref = values['ref']
+    target = os.path.join(target_directory, name)
+
+    partial, sparse_paths = checkout_options(values, blobless, sparse)
+
+    options = []
+    if partial:
+        options.append('--filter=blob:none')
+    if sparse_paths:
+        options.append('--sparse')
+
+    try:
+        RETRY_POLICY.call(source or url, git_clone, target, '--progress', '--depth', '1', *options, source or url, '-b', ref)
+        if sparse_paths:
+            git('-C', target, 'sparse-checkout', 'set', *sparse_paths)
+        if source:
+            git('-C', target, 'remote', 'set-url', 'origin', url)
+    except subprocess.SubprocessError as exp:
+        logger.error('Error while cloning {0}'.format(name))
+        logger.debug(exp)
+        return False
+    except RuntimeError as exp:
+        logger.error('Error while cloning {0}'.format(name))
+        logger.debug(exp)
+        return False
+
+    return True
+
+
+def update_module(module, target_directory, logger, source=None):
+    """
+    Updates an existing checkout in place.
+    Does a shallow fetch of the ref (from source if given, otherwise origin)
+    and only resets the checkout when the fetched commit differs.
+    Returns False if the checkout is missing, corrupt or points to another URL,
+    in which case the module needs a fresh clone.
+    """
+
+    name, values = module
+    url = values['url']
+    ref = values['ref']
+    target = os.path.join(target_directory, name)
+
+    if os.path.islink(target) or not os.path.isdir(os.path.join(target, '.git')):
+        return False
+
+    try:
+        if git_output('-C', target, 'config', '--get', 'remote.origin.url') != url:
+            logger.debug('URL of {0} changed, cloning again'.format(name))
+            return False
+
+        RETRY_POLICY.call(source or url, git, '-C', target, 'fetch', '--progress', '--depth', '1', source or 'origin',
+                          ref)
+        fetched = git_output('-C', target, 'rev-parse', 'FETCH_HEAD')
+
+        if fetched == git_output('-C', target, 'rev-parse', 'HEAD'):
+            logger.debug('{0} is up to date'.format(name))
+            return True
+
+        git('-C', target, 'reset', '--hard', fetched)
+        git('-C', target, 'clean', '-ffdx')
+        logger.debug('Updated {0} to {1}'.format(name, fetched))
+    except (subprocess.SubprocessError, OSError) as exp:
+        logger.debug('Could not update {0}, cloning again'.format(name))
+        logger.debug(exp)
+        return False
+
+    return True
+
+
+def normalize_url(url):
+    """
+    Normalizes a git remote URL so that different spellings of the same repository match.
+    The host is lowercased and a trailing slash or .git suffix is removed.
+    """
+
+    url = url.strip().rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-len('.git')]
+
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme and parsed.netloc:
+        return urllib.parse.urlunsplit((parsed.scheme.lower(), parsed.netloc.lower()) + tuple(parsed[2:]))
+
+    head, sep, path = url.partition(':')
+    if sep and '/' not in head:
+        user, at_sign, host = head.rpartition('@')
+        return user + at_sign + host.lower() + ':' + path
+
+    return url
+
+
+class MirrorCache():
+    """
+    Keeps one bare mirror per repository in a persistent cache directory.
+    Each mirror is fetched at most once per run and then used as local source for all checkouts.
+    """
+
+    def __init__(self, directory, logger):
+
+        self.directory = str(directory)
+        self.logger = logger
+        self.mirrors = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def path(self, url):
+        """
+        Returns the mirror directory for an URL, keyed by the hash of the normalized URL.
+        """
+
+        digest = hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.git')
+
+    def update(self, url):
+        """
+        Creates or fetches the mirror for an URL, once per run.
+        Returns the file:// URL of the mirror or None if the mirror isn't usable.
+        """
+
+        with self.lock:
+            url_lock = self.locks.setdefault(url, threading.Lock())
+
+        with url_lock:
+            if url in self.mirrors:
+                return self.mirrors[url]
+
+            path = self.path(url)
+            source = None
+
+            try:
+                mkdir(self.directory)
+                # Other runs may update the same mirror at the same time
+                with file_lock(path + '.lock'):
+                    source = self.fetch(url, path)
+            except (subprocess.SubprocessError, OSError) as exp:
+                self.logger.error('Error while updating mirror of {0}'.format(url))
+                self.logger.debug(exp)
+
+            self.mirrors[url] = source
+            return source
+
+    @staticmethod
+    def fetch(url, path):
+        """
+        Fetches the mirror or clones it if it doesn't exist yet.
+        Must be called with the lock of the mirror held.
+        Returns the file:// URL of the mirror.
+        """
+
+        if os.path.isdir(path):
+            git('--git-dir', path, 'remote', 'set-url', 'origin', url)
+            RETRY_POLICY.call(url, git, '--git-dir', path, 'fetch', '--progress', '--prune', 'origin')
+        else:
+            RETRY_POLICY.call(url, git_clone, path + '.tmp', '--progress', '--mirror', url)
+            # Allows partial clones from the mirror
+            git('--git-dir', path + '.tmp', 'config', 'uploadpack.allowFilter', 'true')
+            os.rename(path + '.tmp', path)
+
+        return 'file://' + path
+
+
+def git_directory(directory):
+    """
+    Returns the git directory of a checkout, following a .git file (gitdir: ...) as used by worktrees.
+    """
+
+    git_dir = os.path.join(directory, '.git')
+
+    if os.path.isfile(git_dir):
+        with open(git_dir, 'r') as git_file:
+            content = git_file.read().strip()
+        if not content.startswith('gitdir:'):
+            return None
+        git_dir = os.path.join(directory, content[len('gitdir:'):].strip())
+
+    return git_dir
+
+
+def read_ref(git_dirs, ref):
+    """
+    Reads a ref from the loose refs or packed-refs of the given git directories.
+    Returns the content of the ref, which may be another symbolic ref, or None.
+    """
+
+    for git_dir in git_dirs:
+        try:
+            with open(os.path.join(git_dir, ref), 'r') as ref_file:
+                return ref_file.read().strip()
+        except OSError:
+            pass
+
+    for git_dir in git_dirs:
+        try:
+            with open(os.path.join(git_dir, 'packed-refs'), 'r') as packed_file:
+                for line in packed_file:
+                    if line[:1] in ('#', '^'):
+                        continue
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == ref:
+                        return parts[0]
+        except OSError:
+            pass
+
+    return None
+
+
+def read_git_head(directory):
+    """
+    Returns the commit checked out in a git directory by reading HEAD, loose refs and packed-refs.
+    Does not spawn git, so it only costs a few file reads.
+    Returns None if the checkout can't be read this way.
+    """
+
+    try:
+        git_dir = git_directory(directory)
+        if not git_dir:
+            return None
+
+        git_dirs = [git_dir]
+        # Worktrees keep their refs in the common directory
+        if os.path.isfile(os.path.join(git_dir, 'commondir')):
+            with open(os.path.join(git_dir, 'commondir'), 'r') as common_file:
+                git_dirs.append(os.path.join(git_dir, common_file.read().strip()))
+
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as head_file:
+            head = head_file.read().strip()
+    except OSError:
+        return None
+
+    for _ in range(5):
+        if not head.startswith('ref:'):
+            break
+        head = read_ref(git_dirs, head[len('ref:'):].strip())
+        if head is None:
+            return None
+
+    return head if SHA_PATTERN.match(head) else None
+
+
+def head_sha(directory):
+    """
+    Returns the commit checked out in a git directory or None if it isn't a usable checkout.
+    Falls back to git for repositories that can't be read directly, e.g. with the reftable format.
+    """
+
+    sha = read_git_head(directory)
+    if sha or not os.path.exists(os.path.join(directory, '.git')):
+        return sha
+
+    try:
+        return git_output('-C', directory, 'rev-parse', 'HEAD')
+    except (subprocess.SubprocessError, OSError):
+        return None
+
+
+class ModuleStore():
+    """
+    Content addressed store of module checkouts.
+    Every (URL, commit, checkout options) is checked out once below the store directory
+    and the dist directories of all environments link to it.
+    Trees no environment links to are garbage collected, least recently used first,
+    once the store exceeds its size budget. Runs hold the store lock shared while they
+    materialize and link trees, the garbage collection holds it exclusively.
+    """
+
+    def __init__(self, directory, logger, budget=0):
+
+        self.directory = str(directory)
+        self.logger = logger
+        self.budget = budget
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def path(self, module, sha, **clone_options):
+        """
+        Returns the directory of the checkout of a module at a commit.
+        Blobless clones and sparse checkouts of a commit are kept apart from the full checkout.
+        """
+
+        values = module[1]
+        partial, sparse_paths = checkout_options(values, clone_options.get('blobless', False),
+                                                 clone_options.get('sparse', False))
+
+        key = normalize_url(str(values['url']))
+        if partial:
+            key += '\0filter=blob:none'
+        if sparse_paths:
+            key += '\0sparse=' + '\0'.join(sparse_paths)
+
+        key_hash = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, '{0}-{1}'.format(sha, key_hash))
+
+    def contains(self, module, sha, **clone_options):
+        """
+        Checks if the checkout of a module at a commit is in the store.
+        """
+
+        return os.path.isdir(os.path.join(self.path(module, sha, **clone_options), '.git'))
+
+    @contextlib.contextmanager
+    def shared(self):
+        """
+        Context manager that keeps the garbage collection of other runs away,
+        while a tree is materialized and linked.
+        """
+
+        mkdir(self.directory)
+        with file_lock(os.path.join(self.directory, '.lock'), shared=True):
+            yield
+
+    def path_lock(self, path):
+        """
+        Returns the lock serializing the materialization of a store directory.
+        """
+
+        with self.lock:
+            return self.locks.setdefault(path, threading.RLock())
+
+    def materialize(self, module, sha, **clone_options):
+        """
+        Returns the store directory of the module at the commit, cloning it if it's not in the store yet.
+        Concurrent requests for the same commit wait for the first clone.
+        Without a commit, or if the ref moved on since it was resolved, the cloned commit is used.
+        Returns None if the module can't be cloned.
+        """
+
+        if not sha:
+            return self.clone(module, **clone_options)
+
+        path = self.path(module, sha, **clone_options)
+
+        with self.path_lock(path):
+            if self.contains(module, sha, **clone_options):
+                return self.touch(path)
+
+            return self.clone(module, **clone_options)
+
+    def clone(self, module, **clone_options):
+        """
+        Clones the module and moves it into the store under its checked out commit.
+        """
+
+        mkdir(self.directory)
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+
+        try:
+            if not clone_module(module, tmp, self.logger, **clone_options):
+                return None
+
+            staged = os.path.join(tmp, str(module[0]))
+            actual = head_sha(staged)
+            if actual is None:
+                self.logger.error('Checkout of {0} is not valid'.format(module[0]))
+                return None
+
+            path = self.path(module, actual, **clone_options)
+
+            with self.path_lock(path):
+                if not self.contains(module, actual, **clone_options):
+                    rmdir(path)
+                    os.rename(staged, path)
+                    self.logger.debug('Stored {0} at {1}'.format(module[0], path))
+
+            return self.touch(path)
+        finally:
+            rmdir(tmp)
+
+    @staticmethod
+    def touch(path):
+        """
+        Marks a store directory as recently used.
+        """
+
+        os.utime(path)
+        return path
+
+    def collect_garbage(self, dist_dirs):
+        """
+        Removes store directories no dist directory links to.
+        Unreferenced directories are kept, least recently used first removed,
+        as long as the store stays within its budget in bytes.
+        Returns the number of references per store directory.
+        """
+
+        mkdir(self.directory)
+        with file_lock(os.path.join(self.directory, '.lock')):
+            return self.sweep(dist_dirs)
+
+    def sweep(self, dist_dirs):
+        """
+        Counts the references and removes unreferenced directories beyond the budget.
+        Must be called with the store lock held exclusively.
+        """
+
+        references = {}
+
+        for dist_dir in dist_dirs:
+            try:
+                entries = list(os.scandir(dist_dir))
+            except OSError:
+                continue
+
+            for entry in entries:
+                if entry.is_symlink():
+                    target = os.path.realpath(entry.path)
+                    if os.path.dirname(target) == os.path.realpath(self.directory):
+                        references[target] = references.get(target, 0) + 1
+
+        try:
+            trees = [entry for entry in os.scandir(self.directory) if entry.is_dir() and not entry.name.startswith('.')]
+        except OSError:
+            return references
+
+        sizes = {entry.path: directory_size(entry.path) for entry in trees}
+        total = sum(sizes.values())
+
+        unreferenced = sorted((entry for entry in trees if os.path.realpath(entry.path) not in references),
+                              key=lambda entry: entry.stat().st_mtime)
+
+        for entry in unreferenced:
+            if total <= self.budget:
+                break
+            rmdir(entry.path)
+            total -= sizes[entry.path]
+            self.logger.debug('Removed unreferenced {0} from the store'.format(entry.path))
+
+        return references
+
+
+def remote_host(url):
+    """
+    Returns the host of a git remote URL.
+    Handles both URLs (https://host/repo.git) and scp-like syntax (git@host:repo.git).
+    Local paths return an empty string.
+    """
+
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme and parsed.netloc:
+        return parsed.hostname or ''
+
+    head, sep, _ = url.partition(':')
+    if sep and '/' not in head:
+        return head.rpartition('@')[2]
+
+    return ''
+
+
+class HostLimiter():
+    """
+    Limits the number of concurrent git operations against a single remote host.
+    A limit of None disables the cap.
+    """
+
+    def __init__(self, max_per_host=None):
+
+        self.max_per_host = max_per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def semaphore(self, url):
+        """
+        Returns the semaphore for the host of the given URL, or None without a limit.
+        """
+
+        if not self.max_per_host:
+            return None
+
+        host = remote_host(url)
+
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.semaphores[host]
+
+    def acquire(self, url):
+        """
+        Waits for a slot for the host of the given URL.
+        """
+
+        semaphore = self.semaphore(url)
+        if semaphore:
+            semaphore.acquire()
+
+    def release(self, url):
+        """
+        Releases the slot for the host of the given URL.
+        """
+
+        semaphore = self.semaphore(url)
+        if semaphore:
+            semaphore.release()
+
+    @contextlib.contextmanager
+    def limit(self, url):
+        """
+        Context manager that holds a slot for the host of the given URL.
+        """
+
+        self.acquire(url)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+
+# Messages of git failures that are worth retrying, e.g. network problems and overloaded servers
+TRANSIENT_GIT_ERRORS = ['could not resolve host', 'connection timed out', 'connection refused', 'connection reset',
+                        'operation timed out', 'early eof', 'the remote end hung up', 'rpc failed',
+                        'temporary failure', 'gnutls_handshake() failed', 'gnutls recv error', 'ssl_read',
+                        'ssl_connect', 'ssl_error_syscall', 'returned error: 50', 'returned error: 429',
+                        'internal server error', 'service unavailable', 'bad gateway', 'unable to connect',
+                        "couldn't connect to server", 'failed to connect', 'network is unreachable',
+                        'broken pipe', 'index-pack failed']
+
+# Client errors and certificate problems don't go away by retrying, even if the message looks like a network error
+PERMANENT_GIT_ERRORS = re.compile(r'certificate|returned error: 4(?!29)[0-9][0-9]')
+
+
+def is_transient(exp):
+    """
+    Checks if a failed git process is worth retrying.
+    Stalls always are, otherwise the error output is matched against TRANSIENT_GIT_ERRORS
+    and must not match PERMANENT_GIT_ERRORS. Only these failures count towards the circuit breaker.
+    """
+
+    if isinstance(exp, subprocess.TimeoutExpired):
+        return True
+
+    if not isinstance(exp, subprocess.CalledProcessError):
+        return False
+
+    stderr = exp.stderr or b''
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode('utf-8', 'replace')
+
+    stderr = stderr.lower()
+    if PERMANENT_GIT_ERRORS.search(stderr):
+        return False
+
+    return any(message in stderr for message in TRANSIENT_GIT_ERRORS)
+
+
+class HostUnavailable(subprocess.SubprocessError):
+    """
+    Raised instead of running git while the circuit breaker of a host is open.
+    """
+
+
+class RetryPolicy():
+    """
+    Retries transient git failures with jittered exponential backoff,
+    and keeps a circuit breaker per remote host. After failures consecutive
+    transient failures the breaker opens and further operations on the host fail fast
+    for the cooldown, after which the next operation is tried again.
+    The retries taken are counted per thread, so they can be attributed to a module.
+    """
+
+    def __init__(self, retries=2, backoff=1.0, max_backoff=30.0, failures=5, cooldown=60.0):
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = failures
+        self.cooldown = cooldown
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def is_open(self, host):
+        """
+        Checks if operations on the host currently fail fast.
+        """
+
+        with self.lock:
+            failures, failed_at = self.hosts.get(host, (0, 0))
+
+        return bool(self.failures) and failures >= self.failures and time.monotonic() - failed_at < self.cooldown
+
+    def record(self, host, success):
+        """
+        Records the outcome of an operation on the host.
+        """
+
+        with self.lock:
+            if success:
+                self.hosts.pop(host, None)
+            else:
+                self.hosts[host] = (self.hosts.get(host, (0, 0))[0] + 1, time.monotonic())
+
+    def delay(self, attempt):
+        """
+        Returns the jittered backoff before the given retry.
+        """
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def reset_count(self):
+        """
+        Resets the retries counted for the current thread.
+        """
+
+        self.local.count = 0
+
+    def count(self):
+        """
+        Returns the retries taken in the current thread since the last reset.
+        """
+
+        return getattr(self.local, 'count', 0)
+
+    def call(self, url, func, *args):
+        """
+        Calls func with the arguments, an operation against the host of the URL,
+        and retries it on transient failures. Raises HostUnavailable while the breaker is open.
+        """
+
+        host = remote_host(url)
+        attempt = 0
+
+        while True:
+            if self.is_open(host):
+                raise HostUnavailable('{0} failed repeatedly, not trying {1}'.format(host or url, url))
+
+            try:
+                result = func(*args)
+            except subprocess.SubprocessError as exp:
+                if not is_transient(exp):
+                    raise
+                self.record(host, success=False)
+                if attempt >= self.retries:
+                    raise
+            else:
+                self.record(host, success=True)
+                return result
+
+            time.sleep(self.delay(attempt))
+            attempt += 1
+            self.local.count = self.count() + 1
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+def is_vagrant():
+    """
+    Checks if the current machine runs vagrant.
+    """
+
+    return os.path.exists('/vagrant')
+
+
+class FactLoader(YamlLoader):  # pylint: disable=too-many-ancestors
+    """
+    Safe YAML loader which reads Ruby tagged objects (as in Puppet's cached facts) as plain mappings.
+    """
+
+
+FactLoader.add_multi_constructor('!ruby/', lambda loader, suffix, node: loader.construct_mapping(node))
+
+
+def read_fact_file(path, fact):
+    """
+    Reads a fact from an external fact file (txt, yaml or json) or Puppet's cached facts.
+    Returns None if the fact isn't found.
+    """
+
+    try:
+        with open(path, 'r') as fact_file:
+            if path.endswith('.txt'):
+                facts = dict(line.strip().split('=', 1) for line in fact_file if '=' in line)
+            elif path.endswith('.json'):
+                facts = json.load(fact_file)
+            else:
+                facts = yaml.load(fact_file, Loader=FactLoader)
+    except (OSError, ValueError, yaml.YAMLError):
+        return None
+
+    if not isinstance(facts, dict):
+        return None
+
+    # Puppet's cached facts keep the facts below values
+    if isinstance(facts.get('values'), dict):
+        facts = facts['values']
+
+    value = facts.get(fact)
+
+    return str(value) if value not in (None, '') else None
+
+
+def read_location_facts(facts_dirs, cached_facts_dir):
+    """
+    Reads the location from the external fact files and Puppet's cached facts of this machine.
+    Returns None if no file sets it.
+    """
+
+    fact_files = []
+    for facts_dir in facts_dirs:
+        try:
+            fact_files.extend(sorted(os.path.join(facts_dir, name) for name in os.listdir(facts_dir)))
+        except OSError:
+            pass
+    fact_files.append(os.path.join(cached_facts_dir, socket.getfqdn() + '.yaml'))
+
+    for fact_file in fact_files:
+        location = read_fact_file(fact_file, 'location')
+        if location:
+            return location
+
+    return None
+
+
+def get_location(override=None,
+                 cache_dir=None,
+                 ttl=3600,
+                 facts_dirs=('/etc/puppetlabs/facter/facts.d', '/opt/puppetlabs/facter/facts.d'),
+                 cached_facts_dir='/opt/puppetlabs/puppet/cache/yaml/facts'):
+    """
+    Gets the current location fact for this machine.
+    Tries in order: the override or POSTRUN_LOCATION, the cached value if younger than ttl seconds,
+    external fact files and Puppet's cached facts, and facter as last resort.
+    A value found in a fact file or by facter is cached if a cache directory is given.
+    Returns default if nothing is found, which isn't cached.
+    """
+
+    location = override or os.environ.get('POSTRUN_LOCATION')
+    if location:
+        return location
+
+    cache_file = os.path.join(cache_dir, 'location') if cache_dir else None
+
+    try:
+        if cache_file and time.time() - os.path.getmtime(cache_file) < ttl:
+            with open(cache_file, 'r') as location_file:
+                location = location_file.read().strip()
+    except OSError:
+        pass
+
+    if location:
+        return location
+
+    location = read_location_facts(facts_dirs, cached_facts_dir)
+
+    if not location:
+        try:
+            cmd = ['/opt/puppetlabs/bin/facter', 'location']
+            proc = subprocess.check_output(cmd)
+            location = proc.decode("utf-8").rstrip('\n')
+        except (subprocess.CalledProcessError, OSError):
+            # TODO: Add logging for this
+            pass
+
+    # The fallback isn't cached, so the next run asks again
+    if not location:
+        return 'default'
+
+    if cache_file:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, 'w') as location_file:
+                location_file.write(location)
+        except OSError:
+            pass
+
+    return location
+
+
+def parse_ls_remote(output):
+    """
+    Parses the output of git ls-remote into a dictionary of ref name to SHA.
+    """
+
+    refs = {}
+
+    for line in output.splitlines():
+        sha, _, name = line.partition('\t')
+        if name:
+            refs[name.strip()] = sha.strip()
+
+    return refs
+
+
+def lookup_ref(refs, ref):
+    """
+    Looks up the commit of a ref in parsed ls-remote output the way git clone -b would.
+    Branches take precedence over tags, annotated tags are peeled.
+    A full SHA resolves to itself. Returns None if the ref is unknown.
+    """
+
+    for name in ('refs/heads/' + ref, 'refs/tags/' + ref + '^{}', 'refs/tags/' + ref, ref):
+        if name in refs:
+            return refs[name]
+
+    if re.match(r'^[0-9a-f]{40}$', ref):
+        return ref
+
+    return None
+
+
+def ls_remote(url, host_limiter):
+    """
+    Returns the refs of a remote repository, respecting the per host limit.
+    """
+
+    with TRACER.span('ls-remote', url=url), host_limiter.limit(url):
+        return parse_ls_remote(RETRY_POLICY.call(url, git_output, 'ls-remote', url))
+
+
+def resolve_refs(modules, logger, jobs=10, host_limiter=None):
+    """
+    Resolves the commit of every (url, ref) pair of the given module configurations.
+    Runs a single git ls-remote per distinct URL, in parallel.
+    Returns a dictionary of (url, ref) to SHA. Pairs that can't be resolved are left out.
+    """
+
+    host_limiter = host_limiter or HostLimiter()
+    wanted = {}
+
+    for values in modules:
+        wanted.setdefault(str(values['url']), set()).add(str(values['ref']))
+
+    resolved = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(ls_remote, url, host_limiter): url for url in wanted}
+
+        for future in concurrent.futures.as_completed(futures):
+            url = futures[future]
+            try:
+                refs = future.result()
+            except (subprocess.SubprocessError, OSError) as exp:
+                logger.error('Error while resolving refs of {0}'.format(url))
+                logger.debug(exp)
+                continue
+
+            for ref in wanted[url]:
+                sha = lookup_ref(refs, ref)
+                if sha:
+                    resolved[(url, ref)] = sha
+                else:
+                    logger.error('Ref {0} not found in {1}'.format(ref, url))
+
+    return resolved
+
+
+def read_changed_repos(values, stdin=None):
+    """
+    Returns the changed repositories, with - replaced by the lines read from stdin.
+    """
+
+    changed = []
+
+    for value in values:
+        if value == '-':
+            changed += [line.strip() for line in (stdin or sys.stdin) if line.strip()]
+        else:
+            changed.append(value)
+
+    return changed
+
+
+def build_module_index(environment_modules):
+    """
+    Maps the normalized URL and ref of every module to the environments and module names using it.
+    """
+
+    index = {}
+
+    for env, modules in environment_modules.items():
+        # Environments without a usable configuration use no repository
+        for name, values in (modules or {}).items():
+            key = (normalize_url(str(values['url'])), str(values['ref']))
+            index.setdefault(key, []).append((env, str(name)))
+
+    return index
+
+
+def match_changed_repo(value, index):
+    """
+    Returns the index keys matching a URL[@ref], or None if no environment uses the URL.
+    Since SSH URLs contain an @ as well, the ref is only split off if the rest is a known URL.
+    """
+
+    urls = set(url for url, _ in index)
+
+    if normalize_url(value) in urls:
+        return [key for key in index if key[0] == normalize_url(value)]
+
+    url, sep, ref = value.rpartition('@')
+    if sep and normalize_url(url) in urls:
+        if ref.startswith('refs/heads/') or ref.startswith('refs/tags/'):
+            ref = ref.split('/', 2)[2]
+        return [key for key in index if key == (normalize_url(url), ref)]
+
+    return None
+
+
+def changed_modules(changed_repos, environment_modules, logger):
+    """
+    Returns the names of the modules to deploy per environment for the changed repositories.
+    """
+
+    index = build_module_index(environment_modules)
+    targets = {}
+
+    for value in changed_repos:
+        keys = match_changed_repo(value, index)
+
+        if keys is None:
+            logger.warning('%s is not used by any environment', value)
+            continue
+        if not keys:
+            logger.info('%s is not deployed at this ref', value)
+
+        for key in keys:
+            for env, name in index[key]:
+                targets.setdefault(env, set()).add(name)
+
+    return targets
+
+
+def module_delta(previous, current):
+    """
+    Computes the module level difference between two module configurations.
+    Returns a dictionary of added, removed, url_changed and ref_changed module names.
+    """
+
+    delta = {'added': [], 'removed': [], 'url_changed': [], 'ref_changed': []}
+
+    for name, values in current.items():
+        old = previous.get(name)
+
+        if old is None:
+            delta['added'].append(name)
+        elif str(old.get('url')) != str(values['url']):
+            delta['url_changed'].append(name)
+        elif str(old.get('ref')) != str(values['ref']):
+            delta['ref_changed'].append(name)
+
+    delta['removed'] = sorted(set(previous) - set(current))
+
+    return delta
+
+
+class DeploymentState():
+    """
+    Record of the modules deployed in an environment.
+    Stored as JSON file with the URL, ref, commit, time, duration and status of each module,
+    and the fingerprint of the modules.yaml of the last successful run.
+    """
+
+    def __init__(self, path):
+
+        self.path = str(path)
+        data = read_json(self.path, {})
+        self.modules = data.get('modules', {})
+        self.fingerprint = data.get('fingerprint')
+        self.lock = threading.Lock()
+
+    def classify(self, modules, resolved):
+        """
+        Compares the configured modules against the deployed ones.
+        A module is unchanged if its URL and ref didn't change
+        and it was deployed successfully at the resolved commit.
+        Returns a dictionary of unchanged, updated, new and removed module names.
+        """
+
+        delta = module_delta(self.modules, modules)
+        changed = set(delta['url_changed'] + delta['ref_changed'])
+        classes = {'unchanged': [], 'updated': [], 'new': delta['added'], 'removed': delta['removed']}
+
+        for name, values in modules.items():
+            if name in delta['added']:
+                continue
+
+            entry = self.modules[name]
+            sha = resolved.get((str(values['url']), str(values['ref'])))
+
+            if name not in changed and sha and entry.get('status') == 'ok' and entry.get('sha') == sha:
+                classes['unchanged'].append(name)
+            else:
+                classes['updated'].append(name)
+
+        return classes
+
+    def is_current(self, fingerprint, modules, resolved, directory):
+        """
+        Checks if the environment is deployed as configured:
+        the fingerprint matches the last successful run, all modules are unchanged
+        and still checked out in the dist directory, which may have been deleted since.
+        """
+
+        if not fingerprint or fingerprint != self.fingerprint:
+            return False
+
+        if not all(os.path.isdir(os.path.join(directory, str(name), '.git')) for name in modules):
+            return False
+
+        classes = self.classify(modules, resolved)
+
+        return not (classes['updated'] or classes['new'] or classes['removed'])
+
+    def record(self, name, values, sha, duration, status):
+        """
+        Records the deployment of a module.
+        """
+
+        with self.lock:
+            self.modules[name] = {'url': str(values['url']),
+                                  'ref': str(values['ref']),
+                                  'sha': sha,
+                                  'deployed_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                                  'duration': round(duration, 3),
+                                  'status': status}
+
+    def forget(self, name):
+        """
+        Removes a module from the state.
+        """
+
+        with self.lock:
+            self.modules.pop(name, None)
+
+    def save(self):
+        """
+        Writes the state file.
+        """
+
+        with self.lock:
+            write_json(self.path, {'fingerprint': self.fingerprint, 'modules': self.modules})
+
+
+class JobHistory():
+    """
+    Durations and sizes of past module deployments per URL and ref, used to start the longest jobs first.
+    Stored as JSON file. Durations are smoothed over the runs, so a single slow run doesn't dominate.
+    """
+
+    def __init__(self, path):
+
+        self.path = str(path)
+        self.jobs = read_json(self.path, {})
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(url, ref):
+        """
+        Returns the key of a URL and ref.
+        """
+
+        return '{0} {1}'.format(normalize_url(str(url)), ref)
+
+    def estimate(self, url, ref):
+        """
+        Returns the expected duration of deploying the URL and ref.
+        Jobs without history are expected to take as long as the average job.
+        """
+
+        with self.lock:
+            entry = self.jobs.get(self.key(url, ref))
+            if entry:
+                return entry['duration']
+
+            durations = [job['duration'] for job in self.jobs.values()]
+
+        return sum(durations) / len(durations) if durations else 1.0
+
+    def record(self, url, ref, duration, size):
+        """
+        Records the duration and size of a deployment.
+        """
+
+        key = self.key(url, ref)
+
+        with self.lock:
+            entry = self.jobs.get(key)
+            if entry:
+                duration = (entry['duration'] + duration) / 2
+            self.jobs[key] = {'duration': round(duration, 3), 'size': size}
+
+    def save(self):
+        """
+        Writes the history file.
+        """
+
+        with self.lock:
+            write_json(self.path, self.jobs)
+
+
+class Scheduler():
+    """
+    Collects the jobs of all environments and submits them to the executor once started,
+    longest expected job first, so long jobs don't end up in the tail of the run.
+    Returns placeholder futures right away. Jobs submitted after start() are run right away.
+    Logs the estimated remaining time of the run in verbose mode.
+    """
+
+    def __init__(self, executor, logger=None, workers=1):
+
+        self.executor = executor
+        self.logger = logger
+        self.workers = workers
+        self.jobs = []
+        self.started = False
+        self.remaining = 0.0
+        self.done = 0
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, estimate=0.0):
+        """
+        Schedules fn with the arguments and returns its future.
+        """
+
+        job = (estimate, fn, args, concurrent.futures.Future())
+
+        with self.lock:
+            self.remaining += estimate
+            self.total += 1
+            if not self.started:
+                self.jobs.append(job)
+                return job[3]
+
+        self.executor.submit(self.run_job, job)
+        return job[3]
+
+    def start(self):
+        """
+        Submits the collected jobs, longest first.
+        """
+
+        with self.lock:
+            self.started = True
+            jobs = sorted(self.jobs, key=lambda job: job[0], reverse=True)
+            self.jobs = []
+
+        if self.logger and jobs:
+            self.logger.debug('Deploying {0} modules, estimated {1:.1f}s'.format(len(jobs), self.remaining / self.workers))
+
+        for job in jobs:
+            self.executor.submit(self.run_job, job)
+
+    def run_job(self, job):
+        """
+        Runs a job in a worker thread and resolves its future.
+        """
+
+        estimate, fn, args, future = job
+
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            result = fn(*args)
+        except BaseException as exp:  # pylint: disable=broad-except
+            future.set_exception(exp)
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                self.remaining = max(self.remaining - estimate, 0.0)
+                self.done += 1
+                done, total, remaining = self.done, self.total, self.remaining
+
+            if self.logger:
+                self.logger.debug('{0}/{1} jobs done, about {2:.1f}s left'.format(done, total, remaining / self.workers))
+
+
+class EnvironmentLock():
+    """
+    Serializes concurrent runs per environment with file locks.
+    A run arriving while the environment is deployed records a rerun request and exits,
+    the active run then deploys the environment exactly once more.
+    Runs arriving during that follow-up pass wait for the lock instead,
+    so a burst of runs results in at most two passes.
+    Runs a complete pass doesn't cover, e.g. of a module at another branch, always wait for the lock.
+    The request counters are kept in a state file next to the lock, guarded by its own lock.
+    """
+
+    def __init__(self, directory, environment):
+
+        self.directory = directory
+        self.lock_path = os.path.join(directory, environment + '.lock')
+        self.state_path = os.path.join(directory, environment + '.pending')
+        self.lock_file = None
+
+    @contextlib.contextmanager
+    def counters(self):
+        """
+        Locks the state file and yields its counters, which are written back afterwards.
+        """
+
+        with open(self.state_path, 'a+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+
+            try:
+                counters = json.loads(state_file.read() or '{}')
+            except ValueError:
+                counters = {}
+            counters.setdefault('requested', 0)
+            counters.setdefault('started', 0)
+            counters.setdefault('follow_up', False)
+
+            yield counters
+
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(counters))
+
+    def lock(self, blocking=False):
+        """
+        Takes the deploy lock. Returns False if another run holds it.
+        """
+
+        # Held until release(), so it can't be a with block
+        lock_file = open(self.lock_path, 'a')  # pylint: disable=consider-using-with
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        self.lock_file = lock_file
+        return True
+
+    def acquire(self, defer=True):
+        """
+        Returns 'locked' if this run deploys the environment,
+        'deferred' if the active run deploys it again once it is done,
+        and 'covered' if a run that started after this one arrived deployed it.
+        Without defer the run waits for the lock and always returns 'locked'.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Pending requests are left to the follow-up pass of this run, since it doesn't cover them
+        if not defer:
+            self.lock(blocking=True)
+            return 'locked'
+
+        with self.counters() as counters:
+            if self.lock():
+                counters['started'] = counters['requested']
+                counters['follow_up'] = False
+                return 'locked'
+
+            counters['requested'] += 1
+            request = counters['requested']
+            follow_up = counters['follow_up']
+
+        if not follow_up:
+            return 'deferred'
+
+        # The follow-up pass may have started before this run arrived
+        self.lock(blocking=True)
+
+        with self.counters() as counters:
+            if counters['started'] >= request:
+                self.unlock()
+                return 'covered'
+
+            counters['started'] = counters['requested']
+            counters['follow_up'] = False
+
+        return 'locked'
+
+    def finish(self):
+        """
+        Called after a pass. Returns True if a rerun was requested during the first pass,
+        then the lock is kept for the follow-up pass. Otherwise the lock is released.
+        """
+
+        with self.counters() as counters:
+            if counters['requested'] > counters['started'] and not counters['follow_up']:
+                counters['started'] = counters['requested']
+                counters['follow_up'] = True
+                return True
+
+            counters['follow_up'] = False
+            self.unlock()
+
+        return False
+
+    def unlock(self):
+        """
+        Releases the deploy lock.
+        """
+
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def release(self):
+        """
+        Releases the deploy lock if it is still held, also if the run failed.
+        """
+
+        if not self.lock_file:
+            return
+
+        with self.counters() as counters:
+            counters['follow_up'] = False
+            self.unlock()
+
+
+class ModuleLoader():
+    """
+    Loads the modules.yaml and returns the modules as dictionary.
+    """
+
+    def __init__(self,
+                 dir_path,
+                 logger,
+                 environment='production',
+                 location='default',
+                 module=None,
+                 branch=None,
+                 cache_dir=None):
+
+        self.requested_module = module
+        self.requested_branch = branch
+        self.logger = logger
+        self.directory = str(dir_path)
+        self.environment = str(environment)
+        self.location = str(location)
+        self.modules_file_path = os.path.join(dir_path, environment, 'modules.yaml')
+        self.cache_dir = cache_dir
+        self.content_hash = None
+
+        self.modules = {}
+
+    def cache_path(self):
+        """
+        Returns the path of the parsed cache for the modules file.
+        """
+
+        path_hash = hashlib.sha256(os.path.abspath(self.modules_file_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, path_hash + '.json')
+
+    def load_modules_file(self):
+        """
+        Load the modules from the modules file
+        With a cache directory the parsed file is cached, keyed by path, size, mtime and content hash.
+        """
+
+        if not os.path.isfile(self.modules_file_path):
+            self.logger.error('{1} not found for {0}'.format(self.environment, self.modules_file_path))
+            return None
+
+        try:
+            with TRACER.span('load_modules_file', environment=self.environment):
+                return self.parse_modules_file()
+        except (OSError, yaml.YAMLError) as exp:
+            self.logger.error('Could not load {0}: {1}'.format(self.modules_file_path, exp))
+            return None
+
+    def parse_modules_file(self):
+        """
+        Reads the modules file, from the parsed cache if possible.
+        """
+
+        with open(self.modules_file_path, 'rb') as yaml_file:
+            stat = os.fstat(yaml_file.fileno())
+            content = yaml_file.read()
+
+        self.content_hash = hashlib.sha256(content).hexdigest()
+        key = {'path': os.path.abspath(self.modules_file_path),
+               'size': stat.st_size,
+               'mtime': stat.st_mtime_ns,
+               'sha256': self.content_hash}
+
+        if self.cache_dir:
+            cached = read_json(self.cache_path(), {})
+            if cached.get('key') == key:
+                return cached.get('data')
+
+        parsed_yaml = yaml.load(content, Loader=YamlLoader)
+
+        if self.cache_dir:
+            try:
+                write_json(self.cache_path(), {'key': key, 'data': parsed_yaml})
+            except (OSError, TypeError) as exp:
+                self.logger.debug('Could not cache {0}: {1}'.format(self.modules_file_path, exp))
+
+        return parsed_yaml
+
+    def fingerprint(self):
+        """
+        Returns a hash over the content of the modules file and the location.
+        Returns None if there is no modules file.
+        """
+
+        if self.content_hash is None:
+            try:
+                with open(self.modules_file_path, 'rb') as yaml_file:
+                    self.content_hash = hashlib.sha256(yaml_file.read()).hexdigest()
+            except OSError:
+                return None
+
+        digest = hashlib.sha256(self.content_hash.encode('utf-8'))
+        digest.update(b'\0' + self.location.encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def load_modules_from_yaml(self):
+        """
+        Get modules for the specified location
+        Returns None if the modules file is missing or has no modules for the location.
+        """
+
+        yaml = self.load_modules_file()
+
+        try:
+            locations = yaml['modules']
+            if self.location not in locations:
+                self.logger.info('configuration for location %s not found, using default', self.location)
+            modules = locations.get(self.location, locations.get('default'))
+        except (KeyError, TypeError, AttributeError):
+            modules = None
+
+        if not isinstance(modules, dict):
+            self.logger.error('No modules configured for location %s in %s', self.location, self.modules_file_path)
+            return None
+
+        return modules
+
+    def get_modules(self):
+        """
+        Returns the modules as a dictionary
+        Returns None if the configuration is unavailable, which is different from an empty configuration.
+        """
+
+        modules = self.load_modules_from_yaml()
+
+        if modules is None:
+            return None
+
+        if self.requested_module:
+
+            try:
+                module = modules[self.requested_module]
+
+                if self.requested_branch:
+                    module['ref'] = self.requested_branch
+
+                modules = {self.requested_module: module}
+
+            except KeyError:
+                self.logger.error('Module %s not found in configuration', self.requested_module)
+                modules = {}
+
+        return modules
+
+
+class ModuleDeployer():
+    """
+    Deployes the passed modules for Vagrant or on a real machine.
+    """
+
+    def __init__(self,  # pylint: disable=too-many-locals
+                 dir_path,
+                 logger,
+                 modules,
+                 is_vagrant,
+                 hiera_path='/etc/puppetlabs/code/hieradata',
+                 opt_path='/opt/puppet/modules',
+                 environment='production',
+                 jobs=10,
+                 host_limiter=None,
+                 incremental=False,
+                 mirror_cache=None,
+                 resolved=None,
+                 state=None,
+                 force=False,
+                 executor=None,
+                 partial=False,
+                 metrics=None,
+                 blobless=False,
+                 sparse=False,
+                 store=None,
+                 history=None,
+                 prune=False):
+
+        self.logger = logger
+        self.modules = modules
+        self.jobs = jobs
+        self.host_limiter = host_limiter or HostLimiter()
+        self.incremental = incremental
+        self.mirror_cache = mirror_cache
+        self.resolved = resolved or {}
+        self.state = state
+        self.force = force
+        self.executor = executor
+        self.partial = partial
+        self.metrics = metrics
+        self.blobless = blobless
+        self.sparse = sparse
+        self.store = store
+        self.history = history
+        self.prune = prune
+        self.results = {}
+        self.local = set()
+        self.directory = str(dir_path)
+        self.trash = Trash(self.work_path('discarded'))
+        self.is_vagrant = is_vagrant
+        self.opt_path = opt_path
+        self.environment = environment
+        self.hiera_path = os.path.join(hiera_path, environment)
+        self.hiera_opt = '/opt/puppet/hiera'
+
+    def has_opt_module(self, module_name):
+        """
+        Checks if there is there is a module in /opt.
+        Both with dashes and underscores in the name.
+        Returns a boolean and the delimiter of the module folders
+        """
+
+        module_path_dash = os.path.join(self.opt_path, module_name.replace('_', '-'))
+        module_path_underscore = os.path.join(self.opt_path, module_name)
+
+        is_path = os.path.exists(module_path_dash) or os.path.exists(module_path_underscore)
+        delimiter = '_' if os.path.exists(module_path_underscore) else '-'
+
+        return (is_path, delimiter)
+
+    def deploy_hiera(self):
+        """
+        Removes and sets the symlink for the Hiera data in Vagrant.
+        """
+
+        rmdir(self.hiera_path)
+        os.symlink(self.hiera_opt, self.hiera_path)
+
+    def deploy_local(self, module_name, delimiter):
+        """
+        Uses /opt symlinks to deploy this module.
+        """
+
+        src = os.path.join(self.opt_path, module_name.replace('_', delimiter))
+        dst = os.path.join(self.directory, module_name)
+        os.symlink(src, dst)
+
+    def validate_module(self, module):
+        """
+        Checks that a module is deployed and that its HEAD is at the resolved commit of its ref.
+        If HEAD differs, or the ref couldn't be resolved before, the ref is resolved once more,
+        since it may have moved on during the run.
+        Reads the .git directory directly instead of spawning git.
+        """
+
+        module_name = str(module[0])
+        module_dir = os.path.join(self.directory, module_name)
+
+        with TRACER.span('validate', environment=self.environment, module=module_name), \
+                log_context(environment=self.environment, module=module_name):
+            if not os.path.isdir(os.path.join(module_dir, '.git')):
+                self.logger.error('%s not deployed', module_name)
+                return False
+
+            if module_name in self.local:
+                return True
+
+            actual = read_git_head(module_dir)
+
+            if actual is None:
+                self.logger.error('%s has no valid HEAD', module_name)
+                return False
+
+            key = (str(module[1]['url']), str(module[1]['ref']))
+            expected = self.resolved.get(key)
+
+            if actual == expected:
+                return True
+
+            fresh = resolve_refs([module[1]], self.logger, jobs=1, host_limiter=self.host_limiter).get(key)
+            valid = actual == fresh or (fresh is None and expected is None)
+
+            if not valid:
+                self.logger.error('%s is at %s instead of %s', module_name, actual, fresh or expected)
+            elif fresh is None:
+                self.logger.warning('%s could not be resolved, not checking its commit', module_name)
+            elif expected:
+                self.logger.info('%s moved on from %s to %s during the run', module_name, expected, fresh)
+
+        return valid
+
+    def submit_validation(self, executor=None):
+        """
+        Submits the validation of each module to the executor.
+        Without an executor the modules are validated right away.
+        Returns the futures of the validations.
+        """
+
+        futures = []
+
+        for module in self.modules.items():
+            if executor:
+                futures.append(executor.submit(self.validate_module, module))
+            else:
+                future = concurrent.futures.Future()
+                future.set_result(self.validate_module(module))
+                futures.append(future)
+
+        return futures
+
+    def finish_validation(self, futures):
+        """
+        Waits for the submitted validations.
+        Returns True if all modules are deployed correctly.
+        """
+
+        results = []
+
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as exp:  # pylint: disable=broad-except
+                self.logger.error('Error while validating: %s', exp)
+                results.append(False)
+
+        return all(results)
+
+    def validate_deployment(self):
+        """
+        Validate if all modules are deployed correctly
+        """
+
+        return self.finish_validation(self.submit_validation(self.executor))
+
+    @staticmethod
+    def is_deployed(module_dir, url, sha):
+        """
+        Checks if a git checkout of the URL at the given commit is deployed in the directory.
+        """
+
+        if os.path.islink(module_dir) or head_sha(module_dir) != sha:
+            return False
+
+        try:
+            return git_output('-C', module_dir, 'config', '--get', 'remote.origin.url') == url
+        except (subprocess.SubprocessError, OSError):
+            return False
+
+    def deploy_git(self, module):
+        """
+        Deploys a single module from git and records it in the state and metrics.
+        The transferred bytes are estimated from the size of the .git directory.
+        Runs inside a worker thread.
+        """
+
+        module_name = str(module[0])
+        git_dir = os.path.join(self.directory, module_name, '.git')
+        started = time.time()
+
+        old_inode = os.stat(git_dir).st_ino if os.path.isdir(git_dir) else None
+        old_size = directory_size(git_dir) if old_inode and self.metrics else 0
+
+        RETRY_POLICY.reset_count()
+        with TRACER.span('deploy', environment=self.environment, module=module_name), \
+                log_context(environment=self.environment, module=module_name):
+            deployed = self.checkout_git(module)
+        duration = time.time() - started
+        retries = RETRY_POLICY.count()
+
+        sha = head_sha(os.path.join(self.directory, module_name))
+
+        if self.state:
+            self.state.record(module_name,
+                              module[1],
+                              sha=sha,
+                              duration=duration,
+                              status='ok' if deployed else 'failed')
+
+        new_inode = os.stat(git_dir).st_ino if os.path.isdir(git_dir) else None
+        new_size = directory_size(git_dir) if new_inode and (self.metrics or self.history) else 0
+
+        if self.history and deployed:
+            self.history.record(module[1]['url'], module[1]['ref'], duration=duration, size=new_size)
+
+        if self.metrics:
+            transferred = new_size if new_inode != old_inode else max(new_size - old_size, 0)
+            self.metrics.record_module(self.environment, module_name, str(module[1]['url']),
+                                       duration=duration,
+                                       size=transferred,
+                                       retries=retries,
+                                       outcome='ok' if deployed else 'failed')
+
+        return deployed
+
+    def checkout_git(self, module):
+        """
+        Checks out a single module from git, respecting the per host limit.
+        With a module store the module is linked to its checkout in the store.
+        In incremental mode an existing checkout is updated in place,
+        otherwise (or if that fails) the module is cloned into a staging directory
+        and swapped in once it is valid. The old checkout stays in place until then.
+        With a mirror cache the local mirror is used as source.
+        Runs inside a worker thread.
+        """
+
+        module_dir = os.path.join(self.directory, str(module[0]))
+        url = str(module[1]['url'])
+        sha = self.resolved.get((url, str(module[1]['ref'])))
+        source = None
+
+        if self.incremental and sha and self.is_deployed(module_dir, url, sha):
+            self.logger.debug('{0} is already at {1}'.format(module[0], sha))
+            return True
+
+        clone_options = {}
+        if self.blobless:
+            clone_options['blobless'] = True
+        if self.sparse:
+            clone_options['sparse'] = True
+
+        if self.store and sha and self.store.contains(module, sha, **clone_options):
+            with TRACER.span('link', module=module[0]), self.store.shared():
+                return self.link_in(str(module[0]), self.store.materialize(module, sha, **clone_options))
+
+        # Don't queue up behind a host that is down, the deployed checkout stays in place
+        if RETRY_POLICY.is_open(remote_host(url)):
+            self.logger.error('Skipping {0}, {1} failed repeatedly'.format(module[0], remote_host(url) or url))
+            return False
+
+        with TRACER.span('wait_host', url=url):
+            self.host_limiter.acquire(url)
+
+        try:
+            if self.mirror_cache:
+                with TRACER.span('mirror', url=url):
+                    source = self.mirror_cache.update(url)
+
+            if source:
+                clone_options['source'] = source
+
+            if self.store:
+                with self.store.shared():
+                    with TRACER.span('store', module=module[0]):
+                        store_path = self.store.materialize(module, sha, **clone_options)
+                    with TRACER.span('link', module=module[0]):
+                        return bool(store_path) and self.link_in(str(module[0]), store_path)
+
+            if self.incremental:
+                with TRACER.span('update', module=module[0]):
+                    if update_module(module, self.directory, self.logger, source=source):
+                        return True
+
+            staging_dir = self.work_path('staging')
+            mkdir(staging_dir)
+            staging = tempfile.mkdtemp(dir=staging_dir)
+
+            try:
+                with TRACER.span('clone', module=module[0]):
+                    cloned = clone_module(module, staging, self.logger, **clone_options)
+
+                with TRACER.span('swap', module=module[0]):
+                    return cloned and self.swap_in(str(module[0]), os.path.join(staging, str(module[0])))
+            finally:
+                with TRACER.span('rmdir', module=module[0]):
+                    rmdir(staging)
+        finally:
+            self.host_limiter.release(url)
+
+    def work_path(self, *parts):
+        """
+        Returns a path inside the hidden work directory in the dist directory.
+        Puppet ignores it since it is no valid module name,
+        and it is on the same filesystem as the modules, so renames are atomic.
+        """
+
+        return os.path.join(self.directory, '.postrun', *parts)
+
+    def link_in(self, module_name, store_path):
+        """
+        Points the module to its directory in the store.
+        """
+
+        module_dir = os.path.join(self.directory, module_name)
+
+        if os.path.islink(module_dir) and os.path.realpath(module_dir) == os.path.realpath(store_path):
+            return True
+
+        link_directory(store_path, module_dir, self.work_path('trash'), discard=self.trash.discard)
+        self.logger.debug('Linked {0} to {1}'.format(module_dir, store_path))
+
+        return True
+
+    def swap_in(self, module_name, staged_dir):
+        """
+        Replaces the deployed module with the staged checkout, if the checkout is valid.
+        """
+
+        if head_sha(staged_dir) is None:
+            self.logger.error('Staged checkout of {0} is not valid, keeping the deployed one'.format(module_name))
+            return False
+
+        module_dir = os.path.join(self.directory, module_name)
+        swap_directory(staged_dir, module_dir, self.work_path('trash'), discard=self.trash.discard)
+        self.logger.debug('Swapped in {0}'.format(module_dir))
+
+        return True
+
+    def collect_results(self, futures):
+        """
+        Waits for the submitted clones and records the result of each module.
+        Returns True if all modules were deployed.
+        """
+
+        for future in concurrent.futures.as_completed(futures):
+            module_name = futures[future]
+            try:
+                self.results[module_name] = bool(future.result())
+            except Exception as exp:  # pylint: disable=broad-except
+                self.logger.error('Error while deploying %s', module_name)
+                self.logger.debug(exp)
+                self.results[module_name] = False
+
+        return all(self.results.values())
+
+    def estimate(self, module):
+        """
+        Returns the expected duration of deploying a module from git.
+        """
+
+        return self.history.estimate(module[1]['url'], module[1]['ref']) if self.history else 0.0
+
+    def submit_modules(self, scheduler):
+        """
+        Deploys local modules and submits the git modules to the scheduler.
+        Returns the futures of the submitted modules.
+        """
+
+        # Disabled since we switched to g10k
+        # Problem is, that g10k does a shallow clone an removes the .git directory in the hiera repo
+        # if self.is_vagrant:
+        #     self.deploy_hiera()
+
+        futures = {}
+        unchanged = set()
+
+        if self.state:
+            classes = self.state.classify(self.modules, self.resolved)
+            self.logger.info('%s: %s', self.environment,
+                             ', '.join('{0} {1}'.format(len(names), key) for key, names in classes.items()))
+            if not self.force:
+                unchanged = set(classes['unchanged'])
+
+            # Only a complete module list tells which modules were dropped
+            if not self.partial:
+                for module_name in classes['removed']:
+                    self.results[module_name] = self.remove_module(module_name)
+
+        if self.prune and not self.partial:
+            self.prune_directory()
+
+        # Leftovers of an interrupted run
+        if os.path.isdir(self.trash.directory):
+            self.trash.empty()
+
+        for module in self.modules.items():
+            module_name = str(module[0])
+            module_branch = str(module[1]['ref'])
+            module_dir = os.path.join(self.directory, module_name)
+            has_opt_path, delimiter = self.has_opt_module(module_name)
+
+            if module_name in unchanged and os.path.isdir(os.path.join(module_dir, '.git')):
+                self.logger.debug('{0} is unchanged'.format(module_name))
+                self.results[module_name] = True
+                if self.metrics:
+                    self.metrics.record_module(self.environment, module_name, str(module[1]['url']),
+                                               duration=0, size=0, retries=0, outcome='unchanged')
+                continue
+
+            if self.is_vagrant and has_opt_path:
+                rmdir(module_dir)
+                self.logger.debug('Removed {0}'.format(module_dir))
+                self.logger.debug('Deploying local {0}'.format(module_name))
+                self.deploy_local(module_name, delimiter)
+                self.results[module_name] = True
+                self.local.add(module_name)
+                if self.state:
+                    self.state.record(module_name, module[1], sha=None, duration=0, status='local')
+                if self.metrics:
+                    self.metrics.record_module(self.environment, module_name, str(module[1]['url']),
+                                               duration=0, size=0, retries=0, outcome='local')
+                # Continue loop since already deployed local
+                continue
+
+            self.logger.debug('Deploying git {0} with branch {1}'.format(module_name, module_branch))
+            futures[scheduler.submit(self.deploy_git, module, estimate=self.estimate(module))] = module_name
+
+        return futures
+
+    def remove_module(self, module_name):
+        """
+        Removes a module that was dropped from the configuration.
+        It is moved into the trash, which is deleted in the background.
+        """
+
+        module_dir = os.path.join(self.directory, module_name)
+
+        if os.path.lexists(module_dir):
+            self.trash.discard(module_dir)
+            self.logger.info('Removed dropped module {0}'.format(module_dir))
+
+        if self.state:
+            self.state.forget(module_name)
+
+        return True
+
+    def prune_directory(self):
+        """
+        Removes the entries of the dist directory that are no configured module,
+        e.g. modules dropped before there was a state. Hidden entries like the work directory are kept.
+        The directory is scanned once. Returns the names of the removed entries.
+        """
+
+        modules = set(str(name) for name in self.modules)
+
+        try:
+            with os.scandir(self.directory) as entries:
+                stale = [entry.name for entry in entries if not entry.name.startswith('.') and entry.name not in modules]
+        except FileNotFoundError:
+            return []
+
+        for name in stale:
+            self.remove_module(name)
+
+        return stale
+
+    def finish_modules(self, futures):
+        """
+        Waits for the submitted modules and saves the state.
+        Returns True if all modules were deployed.
+        """
+
+        deployment_ok = self.collect_results(futures)
+
+        if self.state:
+            self.state.save()
+
+        return deployment_ok
+
+    def deploy_modules(self):
+        """
+        Loads the modules from either git or sets local symlinks
+        Uses the shared executor if one was passed, otherwise an own pool.
+        Returns True if all modules were deployed.
+        """
+
+        with contextlib.ExitStack() as stack:
+            executor = self.executor or stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs))
+            scheduler = Scheduler(executor, self.logger, workers=self.jobs)
+
+            futures = self.submit_modules(scheduler)
+            scheduler.start()
+
+            return self.finish_modules(futures)
+
+
+def main(args,
+         is_vagrant=False,
+         location='default',
+         puppet_base='/etc/puppetlabs/code/environments/',
+         hiera_base='/etc/puppetlabs/code/hieradata'):
+    """
+    Where the magic happens.
+    """
+
+    if args.profile:
+        TRACER.enable(profiling=bool(args.profile_stats))
+
+    with TRACER.span('main'):
+        deployment_ok = run(args, is_vagrant, location, puppet_base, hiera_base)
+
+    if args.profile:
+        TRACER.write(args.profile, args.profile_stats)
+
+    if not all(deployment_ok):
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+def run(args, is_vagrant, location, puppet_base, hiera_base, logger=None):
+    """
+    Deploys the environments this run holds the lock of and returns the result of each.
+    If another run requested a rerun meanwhile, these environments are deployed once more.
+    """
+
+    if not logger:
+        with TRACER.span('create_logger'):
+            logger = create_logger(log_file=args.log_file, verbose=args.verbose, json_lines=args.log_json)
+
+    GIT_RUNNER.stall_timeout = args.stall_timeout
+    history = JobHistory(os.path.join(args.cache_dir, 'durations.json'))
+    RETRY_POLICY.retries = args.retries
+    RETRY_POLICY.backoff = args.retry_backoff
+    RETRY_POLICY.failures = args.host_failures
+    metrics = Metrics()
+    store = ModuleStore(args.store, logger, budget=args.store_budget * 1024 * 1024) if args.store else None
+
+    environments, targets = select_environments(args, location, puppet_base, logger, metrics)
+    locks = lock_environments(args, environments, logger, metrics)
+
+    try:
+        deployment_ok = deploy_environments(args, list(locks), is_vagrant, location, puppet_base, hiera_base,
+                                            logger=logger, metrics=metrics, store=store, history=history,
+                                            targets=targets)
+
+        # The deferred runs may have asked for other modules, so the follow-up covers all of them
+        follow_up = [env for env, lock in locks.items() if lock.finish()]
+        if follow_up:
+            logger.info('Deploying %s again, another run requested it', ', '.join(follow_up))
+            deployment_ok += deploy_environments(follow_up_args(args), follow_up, is_vagrant, location, puppet_base,
+                                                 hiera_base, logger=logger, metrics=metrics, store=store,
+                                                 history=history)
+    finally:
+        for lock in locks.values():
+            lock.release()
+
+    finish_run(args, puppet_base, logger, metrics, store, history, success=all(deployment_ok))
+
+    return deployment_ok
+
+
+def follow_up_args(args):
+    """
+    Returns the arguments of a follow-up pass, which deploys the complete environments.
+    """
+
+    follow_up = argparse.Namespace(**vars(args))
+    follow_up.module = None
+    follow_up.branch = None
+
+    return follow_up
+
+
+def select_environments(args, location, puppet_base, logger, metrics):
+    """
+    Returns the environments to deploy and, with --changed-repo, the modules to deploy per environment.
+    Exits if the environments directory doesn't exist.
+    """
 
     try:
         environments = os.listdir(puppet_base)
@@ -347,41 +2969,460 @@ def main(args,
         logger.error('%s directory not found', puppet_base)
         sys.exit(1)
 
+    if args.environment:
+        environments = [env for env in environments
+                        if any(fnmatch.fnmatchcase(env, pattern) for pattern in args.environment)]
+
+    targets = None
+    if args.changed_repo:
+        with metrics.phase('index'), TRACER.span('index'):
+            targets = changed_modules(read_changed_repos(args.changed_repo),
+                                      load_environments(args, environments, location, puppet_base, logger),
+                                      logger)
+        environments = [env for env in environments if env in targets]
+
+    return environments, targets
+
+
+def lock_environments(args, environments, logger, metrics):
+    """
+    Locks the environments for this run.
+    Environments deployed by another run are left to it, unless this run requests
+    something its follow-up pass doesn't deploy (a single module, a branch or --force).
+    Returns the locks of the environments this run deploys.
+    """
+
+    locks = {}
+    defer = not (args.module or args.branch or args.force)
+
     for env in environments:
-        logger.info('Postrunning for environment %s', env)
+        lock = EnvironmentLock(os.path.join(args.cache_dir, 'locks'), env)
+        with TRACER.span('lock', environment=env):
+            status = lock.acquire(defer=defer)
+
+        if status == 'deferred':
+            logger.info('Environment %s is deployed by another run, which will deploy it again', env)
+            metrics.finish_environment(env, 'deferred')
+        elif status == 'covered':
+            logger.info('Environment %s was deployed by another run meanwhile', env)
+            metrics.finish_environment(env, 'covered')
+        else:
+            locks[env] = lock
+
+    return locks
+
+
+def finish_run(args, puppet_base, logger, metrics, store, history, success):
+    """
+    Collects the garbage of the store and writes the durations and metrics of the run.
+    """
 
-        dist_dir = os.path.join(puppet_base, env, 'dist')
-        mkdir(dist_dir)
+    # References are counted over all environments, not only the deployed ones
+    if store:
+        with metrics.phase('store_gc'), TRACER.span('store_gc'):
+            store.collect_garbage(os.path.join(puppet_base, env, 'dist') for env in os.listdir(puppet_base))
 
-        hiera_dir = os.path.join(hiera_base, env)
-        mkdir(hiera_dir)
+    try:
+        history.save()
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json, success=success)
+        if args.metrics_textfile:
+            metrics.write_textfile(args.metrics_textfile, success=success)
+    except OSError as exp:
+        logger.error('Error while writing durations or metrics: %s', exp)
+
+
+def load_environments(args, environments, location, puppet_base, logger):
+    """
+    Returns the complete module configuration of each environment.
+    """
+
+    return {env: ModuleLoader(dir_path=puppet_base,
+                              environment=env,
+                              location=location,
+                              logger=logger,
+                              cache_dir=os.path.join(args.cache_dir, 'yaml')).get_modules()
+            for env in environments}
+
+
+def load_deployment(args, environments, location, puppet_base, hiera_base, logger, metrics, targets=None):
+    """
+    Prepares the directories of the environments and loads the modules to deploy.
+    Environments whose modules can't be loaded are reported as failed and left out.
+    Returns the modules and the fingerprint of each loaded environment.
+    """
+
+    environment_modules = {}
+    fingerprints = {}
+
+    for env in environments:
+        mkdir(os.path.join(puppet_base, env, 'dist'))
+        mkdir(os.path.join(hiera_base, env))
 
         moduleloader = ModuleLoader(dir_path=puppet_base,
                                     environment=env,
                                     location=location,
                                     logger=logger,
-                                    module=module,
-                                    branch=branch)
+                                    module=args.module,
+                                    branch=args.branch,
+                                    cache_dir=os.path.join(args.cache_dir, 'yaml'))
 
-        moduledeployer = ModuleDeployer(dir_path=dist_dir,
-                                        is_vagrant=is_vagrant,
-                                        environment=env,
-                                        modules=moduleloader.get_modules(),
-                                        logger=logger)
+        with metrics.phase('load'), TRACER.span('load', environment=env):
+            modules = moduleloader.get_modules()
+            fingerprints[env] = moduleloader.fingerprint()
 
-        moduledeployer.deploy_modules()
-        deployment_ok.append(moduledeployer.validate_deployment())
+        # Without its configuration nothing of the environment may be removed, so it isn't deployed at all
+        if modules is None:
+            logger.error('Deployment of environment %s failed, its modules could not be loaded', env)
+            metrics.finish_environment(env, 'failed')
+            continue
 
-    if not all(deployment_ok):
-        sys.exit(1)
+        if targets is not None:
+            modules = {name: values for name, values in modules.items() if str(name) in targets.get(env, ())}
 
-    sys.exit(0)
+        environment_modules[env] = modules
+
+    return environment_modules, fingerprints
+
+
+def deploy_environments(args, environments, is_vagrant, location, puppet_base, hiera_base, logger, metrics, store,  # pylint: disable=too-many-locals
+                        history=None, targets=None):
+    """
+    Runs one pass over the environments: loads their modules, resolves the refs and deploys them.
+    With targets only the listed modules of each environment are deployed.
+    Returns the result of each deployed environment.
+    """
+
+    partial = bool(args.module) or targets is not None
+
+    host_limiter = HostLimiter(args.host_jobs)
+    mirror_cache = MirrorCache(os.path.join(args.cache_dir, 'mirrors'), logger) if args.mirror else None
+
+    environment_modules, fingerprints = load_deployment(args, environments, location, puppet_base, hiera_base,
+                                                        logger, metrics, targets)
+    # Environments that couldn't be loaded failed
+    deployment_ok = [False] * (len(environments) - len(environment_modules))
+
+    # Resolve all refs upfront, so every repository is only asked once
+    with metrics.phase('resolve'), TRACER.span('resolve'):
+        resolved = resolve_refs([values for modules in environment_modules.values() for values in modules.values()],
+                                logger=logger,
+                                jobs=args.jobs,
+                                host_limiter=host_limiter)
+
+    # All environments share one bounded pool, so the run isn't serialized per environment
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        scheduler = Scheduler(executor, logger, workers=args.jobs)
+        submitted = []
+
+        for env, modules in environment_modules.items():
+            state = DeploymentState(os.path.join(args.cache_dir, 'state', env + '.json'))
+
+            # A partial run never skips, since its modules are explicitly requested
+            if not (partial or args.force) and state.is_current(fingerprints[env], modules, resolved,
+                                                                    os.path.join(puppet_base, env, 'dist')):
+                logger.info('Skipping environment %s, nothing changed since the last run', env)
+                metrics.finish_environment(env, 'skipped')
+                continue
+
+            logger.info('Postrunning for environment %s', env)
+
+            moduledeployer = ModuleDeployer(dir_path=os.path.join(puppet_base, env, 'dist'),
+                                            is_vagrant=is_vagrant,
+                                            environment=env,
+                                            modules=modules,
+                                            logger=logger,
+                                            jobs=args.jobs,
+                                            host_limiter=host_limiter,
+                                            incremental=args.incremental,
+                                            mirror_cache=mirror_cache,
+                                            resolved=resolved,
+                                            state=state,
+                                            force=args.force,
+                                            executor=executor,
+                                            partial=partial,
+                                            metrics=metrics,
+                                            blobless=args.partial_clone,
+                                            sparse=args.sparse,
+                                            store=store,
+                                            history=history,
+                                            prune=not partial)
+
+            metrics.start_environment(env)
+            with metrics.phase('deploy'), TRACER.span('submit', environment=env):
+                submitted.append((env, moduledeployer, moduledeployer.submit_modules(scheduler)))
+
+        # The jobs of all environments are known now, the longest start first
+        scheduler.start()
+
+        deployment_ok += finish_environments(submitted, executor, fingerprints, partial, logger, metrics)
+
+    return deployment_ok
+
+
+def finish_environments(submitted, executor, fingerprints, partial, logger, metrics):
+    """
+    Waits for the submitted environments, validates them and saves their state.
+    Returns the result of each environment.
+    """
+
+    deployment_ok = []
+
+    # Validation of an environment starts as soon as it is deployed and overlaps with the others
+    validations = {}
+    for env, moduledeployer, futures in submitted:
+        with metrics.phase('deploy'), TRACER.span('finish', environment=env):
+            deployed = moduledeployer.finish_modules(futures)
+        validations[env] = (deployed, moduledeployer.submit_validation(executor))
+
+    for env, moduledeployer, futures in submitted:
+        deployed, validation = validations[env]
+
+        with metrics.phase('validate'), TRACER.span('validate', environment=env):
+            validated = moduledeployer.finish_validation(validation)
+
+        if not (deployed and validated):
+            logger.error('Deployment of environment %s failed', env)
+
+        metrics.finish_environment(env, 'ok' if deployed and validated else 'failed')
+
+        # Only a complete and successful run may mark the environment as current
+        if not partial:
+            moduledeployer.state.fingerprint = fingerprints[env] if deployed and validated else None
+            moduledeployer.state.save()
+
+        deployment_ok.append(deployed and validated)
+
+    return deployment_ok
+
+
+# Options a daemon deploys with as requested, all others are its own
+DAEMON_OPTIONS = ('environment', 'module', 'branch', 'changed_repo', 'force', 'location')
+# Options of the client itself, which don't change the deployment
+CLIENT_OPTIONS = ('socket', 'daemon', 'profile', 'profile_stats')
+
+
+def daemon_request(args):
+    """
+    Returns the request for a daemon to deploy as the arguments ask for.
+    Returns None if an option the daemon doesn't take from requests differs from its default,
+    the run must be local then.
+    """
+
+    defaults = vars(commandline([]))
+
+    for option, value in vars(args).items():
+        if option not in DAEMON_OPTIONS + CLIENT_OPTIONS and value != defaults.get(option):
+            return None
+
+    return {option: getattr(args, option) for option in DAEMON_OPTIONS}
+
+
+def request_daemon(socket_path, request):
+    """
+    Sends a deploy request to the daemon and waits for the result.
+    Returns None if no daemon is listening on the socket.
+    """
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        try:
+            client.connect(socket_path)
+        except OSError:
+            return None
+
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with client.makefile('rb') as response_file:
+            response = response_file.readline()
+    finally:
+        client.close()
+
+    # The daemon went away during the run
+    if not response:
+        return False
+
+    return bool(json.loads(response.decode('utf-8')).get('ok'))
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one JSON request per connection and answers with the result of the run.
+    """
+
+    def handle(self):
+
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            request = None
+
+        if not isinstance(request, dict):
+            self.wfile.write(b'{"ok": false, "error": "invalid request"}\n')
+            return
+
+        pending = self.server.postrun.submit(request)
+        pending['done'].wait()
+
+        self.wfile.write(json.dumps({'ok': pending['ok']}).encode('utf-8') + b'\n')
+
+
+class Daemon():
+    """
+    Serves deploy requests on a Unix socket from one long running process,
+    so the interpreter, logger and location lookup stay warm between runs.
+    A single worker deploys the requests one after another.
+    A request equal to a waiting one, or covered by a waiting request for all environments,
+    is coalesced into it, so a burst of webhooks results in one more run.
+    """
+
+    def __init__(self,
+                 args,
+                 is_vagrant,
+                 puppet_base='/etc/puppetlabs/code/environments/',
+                 hiera_base='/etc/puppetlabs/code/hieradata'):
+
+        self.args = args
+        self.is_vagrant = is_vagrant
+        self.puppet_base = puppet_base
+        self.hiera_base = hiera_base
+        self.logger = create_logger(log_file=args.log_file, verbose=args.verbose, json_lines=args.log_json)
+        self.pending = []
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def request_key(request):
+        """
+        Returns the key under which requests are coalesced. No environments means all of them.
+        """
+
+        return (tuple(sorted(request.get('environment') or [])),
+                request.get('module'),
+                request.get('branch'),
+                tuple(sorted(request.get('changed_repo') or [])),
+                bool(request.get('force')),
+                request.get('location'))
+
+    def submit(self, request):
+        """
+        Queues a request or attaches it to a matching waiting one.
+        Returns the pending run, whose done event is set once it finished.
+        """
+
+        key = self.request_key(request)
+
+        with self.condition:
+            for pending in self.pending:
+                if pending['key'] == key or (not pending['key'][0] and pending['key'][1:] == key[1:]):
+                    self.logger.info('Coalescing request for %s into a waiting run', ', '.join(key[0]) or 'all')
+                    return pending
+
+            pending = {'key': key, 'request': request, 'done': threading.Event(), 'ok': None}
+            self.pending.append(pending)
+            self.condition.notify()
+
+        return pending
+
+    def work(self):
+        """
+        Deploys the waiting requests one after another.
+        """
+
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                pending = self.pending.pop(0)
+
+            pending['ok'] = self.deploy(pending['request'])
+            pending['done'].set()
+
+    def deploy(self, request):
+        """
+        Runs a deployment with the options of the daemon and the environments, module and location of the request.
+        Returns True if all environments were deployed.
+        """
+
+        args = argparse.Namespace(**vars(self.args))
+        args.environment = list(request.get('environment') or []) or self.args.environment
+        args.module = request.get('module')
+        args.branch = request.get('branch')
+        args.changed_repo = list(request.get('changed_repo') or [])
+        args.force = self.args.force or bool(request.get('force'))
+        args.location = request.get('location') or self.args.location
+
+        try:
+            location = get_location(override=args.location, cache_dir=args.cache_dir, ttl=args.location_ttl)
+            return all(run(args, self.is_vagrant, location, self.puppet_base, self.hiera_base, logger=self.logger))
+        except SystemExit:
+            # The environments directory is missing
+            return False
+        except Exception as exp:  # pylint: disable=broad-except
+            self.logger.error('Error while deploying: %s', exp)
+            return False
+
+    def listen(self, socket_path):
+        """
+        Binds the socket and starts the worker. Removes a stale socket of a daemon that is gone.
+        Returns the server.
+        """
+
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError('A daemon is already listening on {0}'.format(socket_path))
+            finally:
+                probe.close()
+
+        server = socketserver.ThreadingUnixStreamServer(socket_path, DaemonHandler)
+        server.daemon_threads = True
+        server.postrun = self
+        os.chmod(socket_path, 0o600)
+
+        threading.Thread(target=self.work, name='postrun-daemon', daemon=True).start()
+        self.logger.info('Listening on %s', socket_path)
+
+        return server
+
+    def serve(self, socket_path):
+        """
+        Serves requests until the process is stopped.
+        """
+
+        server = self.listen(socket_path)
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
 
 
 if __name__ == "__main__":
 
     ARGS = commandline(sys.argv[1:])
+    ARGS.changed_repo = read_changed_repos(ARGS.changed_repo)
     IS_VAGRANT = is_vagrant()
-    LOCATION = get_location()
+
+    if ARGS.daemon:
+        Daemon(ARGS, IS_VAGRANT).serve(ARGS.socket)
+        sys.exit(0)
+
+    # With a daemon up this is only a thin client, unless options the daemon doesn't take are given
+    REQUEST = daemon_request(ARGS)
+    if ARGS.socket and not ARGS.profile and REQUEST is not None:
+        RESULT = request_daemon(ARGS.socket, REQUEST)
+        if RESULT is not None:
+            sys.exit(0 if RESULT else 1)
+
+    if ARGS.profile:
+        TRACER.enable(profiling=bool(ARGS.profile_stats))
+
+    with TRACER.span('get_location'):
+        LOCATION = get_location(override=ARGS.location, cache_dir=ARGS.cache_dir, ttl=ARGS.location_ttl)
 
     main(ARGS, IS_VAGRANT, LOCATION)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+
+"""
+Benchmark for end-to-end postrun runs.
+
+Generates local bare git repositories and environments with synthetic modules.yaml files,
+then times postrun.main() cold, warm (nothing changed) and after a small change set.
+Everything runs offline against file:// remotes.
+
+Example:
+    python tests/benchmark.py --repos 20 --environments 10 -- --incremental --mirror
+
+Arguments after -- are passed to postrun.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import postrun  # noqa: E402 pylint: disable=wrong-import-position
+
+
+PHASES = ['load', 'resolve', 'deploy', 'validate']
+
+
+def git(*args):
+
+    subprocess.check_call(['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost'] + list(args),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def commit_files(work_dir, files, file_size, seed):
+    """
+    Writes the files of a synthetic module and commits them.
+    """
+
+    for index in range(files):
+        path = os.path.join(work_dir, 'manifests' if index % 2 else 'files', 'file{0}.pp'.format(index))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as module_file:
+            module_file.write(os.urandom(file_size // 2).hex().encode('ascii') + seed.encode('ascii'))
+
+    git('-C', work_dir, 'add', '-A')
+    git('-C', work_dir, 'commit', '-q', '-m', seed)
+
+
+def create_repositories(base, count, files, file_size):
+    """
+    Creates bare repositories with a production branch.
+    Returns a dictionary of module name to (work directory, file:// URL).
+    """
+
+    repositories = {}
+
+    for index in range(count):
+        name = 'module{0}'.format(index)
+        work_dir = os.path.join(base, 'work', name)
+        bare_dir = os.path.join(base, 'remotes', name + '.git')
+
+        git('init', '-q', '-b', 'production', work_dir)
+        commit_files(work_dir, files, file_size, 'initial')
+        git('clone', '-q', '--bare', work_dir, bare_dir)
+        git('-C', work_dir, 'remote', 'add', 'origin', bare_dir)
+
+        repositories[name] = (work_dir, 'file://' + bare_dir)
+
+    return repositories
+
+
+def create_environments(base, count, repositories):
+    """
+    Creates environments whose modules.yaml lists all repositories.
+    """
+
+    lines = ['modules:', '  default:']
+    for name, (_, url) in sorted(repositories.items()):
+        lines += ['    {0}:'.format(name), "      url: '{0}'".format(url), "      ref: 'production'"]
+
+    for index in range(count):
+        env_dir = os.path.join(base, 'environments', 'env{0}'.format(index))
+        os.makedirs(env_dir)
+        with open(os.path.join(env_dir, 'modules.yaml'), 'w') as yaml_file:
+            yaml_file.write('\n'.join(lines) + '\n')
+
+
+def run_postrun(base, postrun_args):
+    """
+    Runs postrun.main() once and returns the exit code, total and phase timings from the metrics report.
+    """
+
+    report = os.path.join(base, 'metrics.json')
+    args = postrun.commandline(['--cache-dir', os.path.join(base, 'cache'), '--metrics-json', report] + postrun_args)
+
+    started = time.monotonic()
+    try:
+        postrun.main(args,
+                     location='default',
+                     puppet_base=os.path.join(base, 'environments'),
+                     hiera_base=os.path.join(base, 'hieradata'))
+        code = 0
+    except SystemExit as exp:
+        code = exp.code
+    total = time.monotonic() - started
+
+    with open(report, 'r') as report_file:
+        phases = json.load(report_file)['phases']
+
+    return code, total, {phase: phases.get(phase, 0.0) for phase in PHASES}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark end-to-end postrun runs against local repositories')
+    parser.add_argument('--repos', type=int, default=10, help='Number of module repositories')
+    parser.add_argument('--environments', type=int, default=5, help='Number of environments')
+    parser.add_argument('--files', type=int, default=20, help='Files per repository')
+    parser.add_argument('--file-size', type=int, default=4096, help='Bytes per file')
+    parser.add_argument('--changes', type=int, default=1, help='Repositories changed for the change set run')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated directory')
+    parser.add_argument('postrun_args', nargs='*', help='Arguments passed to postrun (after --)')
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix='postrun-benchmark-')
+
+    logger = logging.getLogger('postrun-benchmark')
+    logger.addHandler(logging.FileHandler(os.path.join(base, 'postrun.log')))
+    logger.setLevel(logging.DEBUG)
+    postrun.create_logger = lambda *args, **kwargs: logger
+
+    try:
+        print('Generating {0} repositories and {1} environments in {2}'.format(args.repos, args.environments, base))
+        repositories = create_repositories(base, args.repos, args.files, args.file_size)
+        create_environments(base, args.environments, repositories)
+
+        results = [('cold',) + run_postrun(base, args.postrun_args),
+                   ('warm',) + run_postrun(base, args.postrun_args)]
+
+        for name in sorted(repositories)[:args.changes]:
+            work_dir = repositories[name][0]
+            commit_files(work_dir, 1, args.file_size, 'change')
+            git('-C', work_dir, 'push', '-q', 'origin', 'production')
+
+        results.append(('change',) + run_postrun(base, args.postrun_args))
+
+        print('{0:<8} {1:>5} {2:>9} '.format('run', 'exit', 'total') +
+              ' '.join('{0:>9}'.format(phase) for phase in PHASES))
+        for name, code, total, timings in results:
+            print('{0:<8} {1:>5} {2:>8.3f}s '.format(name, code, total) +
+                  ' '.join('{0:>8.3f}s'.format(timings[phase]) for phase in PHASES))
+    finally:
+        if args.keep:
+            print('Kept {0}'.format(base))
+        else:
+            shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
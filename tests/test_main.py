@@ -3,6 +3,7 @@
 
 import pytest
 import os
+import threading
 import unittest.mock as mock
 
 import postrun
@@ -20,12 +21,12 @@ def module():
 @mock.patch('postrun.ModuleLoader')
 @mock.patch('postrun.ModuleDeployer')
 @mock.patch('postrun.create_logger')
-def test_main_no_folder(mock_log, mock_deploy, mock_mods, mock_os, capsys):
+def test_main_no_folder(mock_log, mock_deploy, mock_mods, mock_os, capsys, tmpdir):
     """
     Test main function without existing folder. Should exit with 2
     """
 
-    mock_args = mock.MagicMock()
+    mock_args = postrun.commandline(['--cache-dir', str(tmpdir)])
     mock_os.side_effect = FileNotFoundError()
 
     with pytest.raises(SystemExit):
@@ -39,13 +40,13 @@ def test_main_no_folder(mock_log, mock_deploy, mock_mods, mock_os, capsys):
 @mock.patch('postrun.create_logger')
 @mock.patch('sys.exit')
 @mock.patch('postrun.mkdir')
-def test_main_regular(mock_mk, sys_exit, mock_log, mock_deploy, mock_mods, mock_os, module):
+def test_main_regular(mock_mk, sys_exit, mock_log, mock_deploy, mock_mods, mock_os, module, tmpdir):
     """
     Test main function regularly. Should call deploy_modules
     """
 
     mock_os.return_value = ['production', 'staging']
-    mock_args = mock.MagicMock()
+    mock_args = postrun.commandline(['--cache-dir', str(tmpdir)])
 
     postrun.main(args=mock_args, is_vagrant=False)
 
@@ -63,13 +64,13 @@ def test_main_regular(mock_mk, sys_exit, mock_log, mock_deploy, mock_mods, mock_
 @mock.patch('postrun.create_logger')
 @mock.patch('sys.exit')
 @mock.patch('postrun.mkdir')
-def test_main_vagrant(mock_mk, sys_exit, mock_log, mock_deploy, mock_mods, mock_os, module):
+def test_main_vagrant(mock_mk, sys_exit, mock_log, mock_deploy, mock_mods, mock_os, module, tmpdir):
     """
     Test main function called in Vagrant. Should call deploy_modules_vagrant
     """
 
     mock_os.return_value = ['production', 'staging']
-    mock_args = mock.MagicMock()
+    mock_args = postrun.commandline(['--cache-dir', str(tmpdir)])
 
     postrun.main(args=mock_args, is_vagrant=True)
 
@@ -110,3 +111,277 @@ def test_commandline_module():
     test_parser = postrun.commandline(['-b', 'foobar'])
 
     assert(test_parser.branch == 'foobar')
+
+@pytest.mark.main
+def test_commandline_jobs():
+    """
+    Test that the parallelism can be configured.
+    """
+
+    test_parser = postrun.commandline(['-j', '4', '--host-jobs', '2'])
+
+    assert(test_parser.jobs == 4)
+    assert(test_parser.host_jobs == 2)
+    assert(postrun.commandline([]).jobs == 10)
+
+
+@pytest.mark.main
+@mock.patch('os.listdir')
+@mock.patch('postrun.ModuleLoader')
+@mock.patch('postrun.ModuleDeployer')
+@mock.patch('postrun.create_logger')
+@mock.patch('postrun.mkdir')
+def test_main_shared_pool(mock_mk, mock_log, mock_deploy, mock_mods, mock_os, tmpdir):
+    """
+    Test that all environments are submitted to one pool and validated each
+    """
+
+    mock_os.return_value = ['production', 'staging']
+    mock_deploy.return_value.finish_modules.side_effect = [True, False]
+    mock_deploy.return_value.finish_validation.return_value = True
+
+    with pytest.raises(SystemExit) as exit_info:
+        postrun.main(args=postrun.commandline(['--cache-dir', str(tmpdir)]), is_vagrant=False)
+
+    assert(exit_info.value.code == 1)
+    executors = set(id(call[1]['executor']) for call in mock_deploy.call_args_list)
+    assert(len(executors) == 1)
+    assert(mock_deploy.return_value.submit_modules.call_count == 2)
+    assert(mock_deploy.return_value.submit_validation.call_count == 2)
+    assert(mock_deploy.return_value.finish_validation.call_count == 2)
+
+
+@pytest.mark.main
+@mock.patch('os.listdir')
+@mock.patch('postrun.ModuleLoader')
+@mock.patch('postrun.ModuleDeployer')
+@mock.patch('postrun.create_logger')
+@mock.patch('sys.exit')
+@mock.patch('postrun.mkdir')
+def test_main_environment_filter(mock_mk, sys_exit, mock_log, mock_deploy, mock_mods, mock_os, tmpdir):
+    """
+    Test that only environments matching the patterns are deployed
+    """
+
+    mock_os.return_value = ['production', 'staging', 'feature_foo', 'feature_bar']
+    mock_args = postrun.commandline(['--cache-dir', str(tmpdir), '-e', 'feature_*', '--environment', 'production'])
+
+    postrun.main(args=mock_args, is_vagrant=False)
+
+    environments = sorted(call[1]['environment'] for call in mock_deploy.call_args_list)
+    assert(environments == ['feature_bar', 'feature_foo', 'production'])
+
+
+@pytest.mark.main
+@mock.patch('os.listdir', return_value=['production'])
+@mock.patch('postrun.resolve_refs')
+@mock.patch('postrun.ModuleLoader')
+@mock.patch('postrun.ModuleDeployer')
+@mock.patch('postrun.create_logger')
+@mock.patch('sys.exit')
+@mock.patch('postrun.mkdir')
+def test_main_skip_unchanged_environment(mock_mk, sys_exit, mock_log, mock_deploy, mock_mods, mock_resolve, mock_os, module, tmpdir):
+    """
+    Test that an environment is skipped if fingerprint and commits match the last run and its modules exist
+    """
+
+    url = 'https://github.com/vision-it/puppet-roles.git'
+    mock_mods.return_value.get_modules.return_value = module
+    mock_mods.return_value.fingerprint.return_value = 'abc'
+    mock_resolve.return_value = {(url, 'production'): 'b' * 40}
+
+    state = postrun.DeploymentState(str(tmpdir.join('state', 'production.json')))
+    state.record('roles', module['roles'], sha='b' * 40, duration=1, status='ok')
+    state.fingerprint = 'abc'
+    state.save()
+
+    puppet_base = tmpdir.join('environments')
+    puppet_base.join('production', 'dist', 'roles', '.git').ensure(dir=True)
+
+    postrun.main(args=postrun.commandline(['--cache-dir', str(tmpdir)]), is_vagrant=False,
+                 puppet_base=str(puppet_base))
+    assert(mock_deploy.call_count == 0)
+
+    postrun.main(args=postrun.commandline(['--cache-dir', str(tmpdir), '--force']), is_vagrant=False,
+                 puppet_base=str(puppet_base))
+    assert(mock_deploy.call_count == 1)
+
+    # The dist directory was deleted, e.g. because the branch was recreated
+    puppet_base.join('production', 'dist').remove()
+    postrun.main(args=postrun.commandline(['--cache-dir', str(tmpdir)]), is_vagrant=False,
+                 puppet_base=str(puppet_base))
+    assert(mock_deploy.call_count == 2)
+
+
+@pytest.mark.main
+@mock.patch('postrun.create_logger')
+def test_daemon_coalesce(mock_log):
+    """
+    Test that requests equal to or covered by a waiting one are coalesced into it
+    """
+
+    daemon = postrun.Daemon(postrun.commandline([]), is_vagrant=False)
+
+    first = daemon.submit({'environment': ['production']})
+    assert(daemon.submit({'environment': ['production']}) is first)
+    assert(daemon.submit({'environment': ['staging']}) is not first)
+
+    assert(daemon.submit({'environment': ['production'], 'location': 'office'}) is not first)
+
+    everything = daemon.submit({})
+    assert(daemon.submit({'environment': ['feature_foo']}) is everything)
+    assert(daemon.submit({'environment': ['feature_foo'], 'module': 'roles'}) is not everything)
+    assert(len(daemon.pending) == 5)
+
+
+@pytest.mark.main
+@mock.patch('postrun.get_location', return_value='default')
+@mock.patch('postrun.run', return_value=[True])
+@mock.patch('postrun.create_logger')
+def test_daemon_socket(mock_log, mock_run, mock_location, tmpdir):
+    """
+    Test that the client gets the result of a run from the daemon
+    """
+
+    socket_path = str(tmpdir.join('postrun.sock'))
+    assert(postrun.request_daemon(socket_path, {}) is None)
+
+    daemon = postrun.Daemon(postrun.commandline(['-e', 'production']), is_vagrant=False)
+    server = daemon.listen(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        assert(postrun.request_daemon(socket_path, {'module': 'roles', 'location': 'office'}) == True)
+        mock_run.return_value = [True, False]
+        assert(postrun.request_daemon(socket_path, {'environment': ['staging']}) == False)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    first, second = [call[0][0] for call in mock_run.call_args_list]
+    assert((first.environment, first.module, first.location) == (['production'], 'roles', 'office'))
+    assert((second.environment, second.module, second.location) == (['staging'], None, None))
+    assert(mock_location.call_args_list[0][1]['override'] == 'office')
+    assert(mock_run.call_args[1]['logger'] is daemon.logger)
+
+
+@pytest.mark.main
+@mock.patch('os.listdir')
+@mock.patch('postrun.ModuleLoader')
+@mock.patch('postrun.ModuleDeployer')
+@mock.patch('postrun.create_logger')
+@mock.patch('sys.exit')
+@mock.patch('postrun.mkdir')
+def test_main_locked_environment(mock_mk, sys_exit, mock_log, mock_deploy, mock_mods, mock_os, tmpdir):
+    """
+    Test that an environment deployed by another run is deferred to it and deployed again there
+    """
+
+    mock_os.return_value = ['production', 'staging']
+    mock_deploy.return_value.finish_validation.return_value = True
+    active = postrun.EnvironmentLock(str(tmpdir.join('locks')), 'production')
+    active.acquire()
+
+    postrun.main(args=postrun.commandline(['--cache-dir', str(tmpdir)]), is_vagrant=False)
+
+    assert([call[1]['environment'] for call in mock_deploy.call_args_list] == ['staging'])
+    sys_exit.assert_called_once_with(0)
+    assert(active.finish() == True)
+
+
+@pytest.mark.main
+@mock.patch('os.listdir')
+@mock.patch('postrun.resolve_refs', return_value={})
+@mock.patch('postrun.ModuleLoader')
+@mock.patch('postrun.ModuleDeployer')
+@mock.patch('postrun.create_logger')
+@mock.patch('sys.exit')
+@mock.patch('postrun.mkdir')
+def test_main_changed_repo(mock_mk, sys_exit, mock_log, mock_deploy, mock_mods, mock_resolve, mock_os, tmpdir):
+    """
+    Test that only the environments and modules using a changed repository are deployed
+    """
+
+    mock_os.return_value = ['production', 'staging', 'feature']
+    mock_mods.side_effect = lambda **kwargs: mock.MagicMock(**{'get_modules.return_value': {
+        'roles': {'url': 'https://github.com/vision-it/puppet-roles.git', 'ref': kwargs['environment']},
+        'base': {'url': 'https://github.com/vision-it/puppet-base.git', 'ref': 'production'}}})
+
+    postrun.main(args=postrun.commandline(['--cache-dir', str(tmpdir),
+                                           '--changed-repo', 'https://github.com/vision-it/puppet-roles@staging',
+                                           '--changed-repo', 'https://github.com/vision-it/puppet-unknown']),
+                 is_vagrant=False)
+
+    assert([call[1]['environment'] for call in mock_deploy.call_args_list] == ['staging'])
+    assert(list(mock_deploy.call_args[1]['modules']) == ['roles'])
+    assert(mock_deploy.call_args[1]['partial'] == True)
+
+
+@pytest.mark.main
+@mock.patch('postrun.create_logger')
+def test_main_missing_modules_file(mock_log, tmpdir):
+    """
+    Test that nothing is removed from an environment whose modules.yaml is missing
+    """
+
+    puppet_base = tmpdir.join('environments')
+    dist = puppet_base.join('production', 'dist')
+    dist.join('roles', 'metadata.json').write('{}', ensure=True)
+    state = postrun.DeploymentState(str(tmpdir.join('cache', 'state', 'production.json')))
+    state.record('roles', {'url': 'https://github.com/vision-it/puppet-roles.git', 'ref': 'production'},
+                 'a' * 40, 1.0, 'ok')
+    state.save()
+
+    with mock.patch('postrun.ModuleDeployer.remove_module') as mock_remove:
+        deployment_ok = postrun.run(postrun.commandline(['--cache-dir', str(tmpdir.join('cache'))]),
+                                    is_vagrant=False, location='default', puppet_base=str(puppet_base),
+                                    hiera_base=str(tmpdir.join('hieradata')))
+
+    assert(deployment_ok == [False])
+    mock_remove.assert_not_called()
+    assert(dist.join('roles', 'metadata.json').check())
+    assert('roles' in postrun.DeploymentState(state.path).modules)
+
+
+@pytest.mark.main
+@mock.patch('postrun.create_logger')
+def test_main_missing_modules_file_no_prune(mock_log, tmpdir):
+    """
+    Test that the dist directory isn't pruned if the modules.yaml is missing, but is if it is empty
+    """
+
+    puppet_base = tmpdir.join('environments')
+    dist = puppet_base.join('production', 'dist')
+    dist.join('unmanaged', 'metadata.json').write('{}', ensure=True)
+    args = postrun.commandline(['--cache-dir', str(tmpdir.join('cache'))])
+
+    def run():
+        return postrun.run(args, is_vagrant=False, location='default', puppet_base=str(puppet_base),
+                           hiera_base=str(tmpdir.join('hieradata')))
+
+    with mock.patch('postrun.ModuleDeployer.prune_directory') as mock_prune:
+        assert(run() == [False])
+        mock_prune.assert_not_called()
+    assert(dist.join('unmanaged').check())
+
+    puppet_base.join('production', 'modules.yaml').write("modules:\n  default: {}\n")
+    assert(run() == [True])
+    assert(not dist.join('unmanaged').check())
+
+
+@pytest.mark.main
+def test_daemon_request():
+    """
+    Test that options the daemon doesn't take from requests make the run local
+    """
+
+    request = postrun.daemon_request(postrun.commandline(['-e', 'production', '-l', 'office', '-m', 'roles']))
+    assert(request['environment'] == ['production'])
+    assert((request['location'], request['module'], request['force']) == ('office', 'roles', False))
+
+    assert(postrun.daemon_request(postrun.commandline(['--socket', '/tmp/postrun.sock'])) is not None)
+
+    for options in [['--cache-dir', '/tmp/cache'], ['-i'], ['--store', '/tmp/store'], ['-j', '2'], ['-v'],
+                    ['--metrics-json', '/tmp/metrics.json']]:
+        assert(postrun.daemon_request(postrun.commandline(options)) is None)
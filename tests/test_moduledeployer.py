@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 
+import concurrent.futures
 import pytest
 import os
+import threading
+import subprocess
 import unittest.mock as mock
 
 import postrun
@@ -124,15 +127,16 @@ def test_moduledeployer_has_opt_module(mock_path, module):
     assert((True, '_') == return_val)
 
 @pytest.mark.deploy
-@mock.patch('postrun.rmdir')
-@mock.patch('postrun.clone_module')
-def test_moduledeployer_deploy_modules_regular(mock_clone, mock_rmdir, module):
+@mock.patch('postrun.swap_directory')
+@mock.patch('postrun.head_sha', return_value='b' * 40)
+@mock.patch('postrun.clone_module', return_value=True)
+def test_moduledeployer_deploy_modules_regular(mock_clone, mock_sha, mock_swap, module, tmpdir):
     """
-    Test that git clone gets called
+    Test that git clone gets called in a staging directory, which is swapped in
     """
 
     mock_logger = mock.MagicMock()
-    md = postrun.ModuleDeployer(dir_path='/tmp',
+    md = postrun.ModuleDeployer(dir_path=str(tmpdir),
                                 is_vagrant=False,
                                 logger=mock_logger,
                                 modules=module,
@@ -140,10 +144,36 @@ def test_moduledeployer_deploy_modules_regular(mock_clone, mock_rmdir, module):
 
     md.deploy_modules()
 
-    mock_rmdir.assert_called_once_with('/tmp/roles')
+    staging = mock_clone.call_args[0][1]
+    assert(os.path.dirname(staging) == str(tmpdir.join('.postrun', 'staging')))
     mock_clone.assert_called_once_with(('roles',
                                         {'url': 'https://github.com/vision-it/puppet-roles.git',
-                                         'ref': 'production'}), '/tmp', mock_logger)
+                                         'ref': 'production'}), staging, mock_logger)
+    mock_swap.assert_called_once_with(os.path.join(staging, 'roles'),
+                                      str(tmpdir.join('roles')),
+                                      str(tmpdir.join('.postrun', 'trash')),
+                                      discard=md.trash.discard)
+    assert(not os.path.exists(staging))
+
+
+@pytest.mark.deploy
+@mock.patch('postrun.swap_directory')
+@mock.patch('postrun.head_sha', return_value=None)
+@mock.patch('postrun.clone_module', return_value=True)
+def test_moduledeployer_deploy_modules_invalid_staging(mock_clone, mock_sha, mock_swap, module, tmpdir):
+    """
+    Test that an invalid staged checkout doesn't replace the deployed module
+    """
+
+    mock_logger = mock.MagicMock()
+    md = postrun.ModuleDeployer(dir_path=str(tmpdir),
+                                is_vagrant=False,
+                                logger=mock_logger,
+                                modules=module,
+                                environment='foobar')
+
+    assert(md.deploy_modules() == False)
+    mock_swap.assert_not_called()
 
 
 @pytest.mark.deploy
@@ -170,18 +200,18 @@ def test_moduledeployer_deploy_modules_vagrant_local(mock_clone, mock_opt, mock_
     mock_local.assert_called_once_with('roles', '_')
 
 @pytest.mark.deploy
-@mock.patch('postrun.rmdir')
+@mock.patch('postrun.swap_directory')
 @mock.patch('postrun.ModuleDeployer.deploy_hiera')
 @mock.patch('postrun.ModuleDeployer.deploy_local')
 @mock.patch('postrun.ModuleDeployer.has_opt_module', return_value=(False, '_'))
 @mock.patch('postrun.clone_module')
-def test_moduledeployer_deploy_modules_vagrant_git(mock_clone, mock_opt, mock_local, mock_hiera, mock_rmdir, module):
+def test_moduledeployer_deploy_modules_vagrant_git(mock_clone, mock_opt, mock_local, mock_hiera, mock_swap, module, tmpdir):
     """
     Test that git clone gets called  in vagrant
     """
 
     mock_logger = mock.MagicMock()
-    md = postrun.ModuleDeployer(dir_path='/tmp',
+    md = postrun.ModuleDeployer(dir_path=str(tmpdir),
                                 is_vagrant=True,
                                 logger=mock_logger,
                                 modules=module,
@@ -189,7 +219,361 @@ def test_moduledeployer_deploy_modules_vagrant_git(mock_clone, mock_opt, mock_lo
 
     md.deploy_modules()
 
-    mock_rmdir.assert_called_once_with('/tmp/roles')
+    mock_local.assert_not_called()
     mock_clone.assert_called_once_with(('roles',
                                         {'url': 'https://github.com/vision-it/puppet-roles.git',
-                                         'ref': 'production'}), '/tmp', mock_logger)
+                                         'ref': 'production'}), mock.ANY, mock_logger)
+
+
+@pytest.mark.deploy
+@mock.patch('postrun.swap_directory')
+@mock.patch('postrun.head_sha', return_value='b' * 40)
+@mock.patch('postrun.clone_module')
+def test_moduledeployer_deploy_modules_parallel(mock_clone, mock_sha, mock_swap, tmpdir):
+    """
+    Test that clones run in the worker pool and failures are aggregated
+    """
+
+    modules = {'roles': {'ref': 'production', 'url': 'https://github.com/vision-it/puppet-roles.git'},
+               'base': {'ref': 'production', 'url': 'https://github.com/vision-it/puppet-base.git'}}
+    mock_clone.side_effect = lambda module, directory, logger: module[0] == 'roles'
+
+    mock_logger = mock.MagicMock()
+    md = postrun.ModuleDeployer(dir_path=str(tmpdir),
+                                is_vagrant=False,
+                                logger=mock_logger,
+                                modules=modules,
+                                environment='foobar',
+                                jobs=2)
+
+    actual = md.deploy_modules()
+
+    assert(actual == False)
+    assert(md.results == {'roles': True, 'base': False})
+
+
+@pytest.mark.deploy
+@mock.patch('postrun.clone_module', side_effect=RuntimeError('boom'))
+def test_moduledeployer_deploy_modules_exception(mock_clone, module, tmpdir):
+    """
+    Test that an exception in a worker marks the module as failed
+    """
+
+    mock_logger = mock.MagicMock()
+    md = postrun.ModuleDeployer(dir_path=str(tmpdir),
+                                is_vagrant=False,
+                                logger=mock_logger,
+                                modules=module,
+                                environment='foobar')
+
+    assert(md.deploy_modules() == False)
+    assert(md.results == {'roles': False})
+
+
+@pytest.mark.deploy
+@mock.patch('postrun.rmdir')
+@mock.patch('postrun.update_module', return_value=True)
+@mock.patch('postrun.clone_module')
+def test_moduledeployer_deploy_modules_incremental(mock_clone, mock_update, mock_rmdir, module):
+    """
+    Test that incremental mode updates in place without cloning
+    """
+
+    mock_logger = mock.MagicMock()
+    md = postrun.ModuleDeployer(dir_path='/tmp',
+                                is_vagrant=False,
+                                logger=mock_logger,
+                                modules=module,
+                                environment='foobar',
+                                incremental=True)
+
+    assert(md.deploy_modules() == True)
+    mock_rmdir.assert_not_called()
+    mock_clone.assert_not_called()
+
+
+@pytest.mark.deploy
+@mock.patch('postrun.update_module', return_value=False)
+@mock.patch('postrun.clone_module')
+def test_moduledeployer_deploy_modules_incremental_fallback(mock_clone, mock_update, module, tmpdir):
+    """
+    Test that a failed update falls back to a fresh clone
+    """
+
+    mock_logger = mock.MagicMock()
+    md = postrun.ModuleDeployer(dir_path=str(tmpdir),
+                                is_vagrant=False,
+                                logger=mock_logger,
+                                modules=module,
+                                environment='foobar',
+                                incremental=True)
+
+    md.deploy_modules()
+
+    assert(mock_clone.call_count == 1)
+
+
+@pytest.mark.deploy
+@mock.patch('postrun.ModuleDeployer.is_deployed', return_value=True)
+@mock.patch('postrun.update_module')
+@mock.patch('postrun.clone_module')
+def test_moduledeployer_deploy_modules_resolved(mock_clone, mock_update, mock_deployed, module):
+    """
+    Test that a checkout at the resolved commit is not touched
+    """
+
+    mock_logger = mock.MagicMock()
+    md = postrun.ModuleDeployer(dir_path='/tmp',
+                                is_vagrant=False,
+                                logger=mock_logger,
+                                modules=module,
+                                environment='foobar',
+                                incremental=True,
+                                resolved={('https://github.com/vision-it/puppet-roles.git', 'production'): 'b' * 40})
+
+    assert(md.deploy_modules() == True)
+    mock_deployed.assert_called_once_with('/tmp/roles', 'https://github.com/vision-it/puppet-roles.git', 'b' * 40)
+    mock_update.assert_not_called()
+    mock_clone.assert_not_called()
+
+
+@pytest.mark.deploy
+def test_deployment_state_classify(tmpdir, module):
+    """
+    Test that modules are classified against the saved state
+    """
+
+    path = str(tmpdir.join('state', 'foobar.json'))
+    url = 'https://github.com/vision-it/puppet-roles.git'
+
+    state = postrun.DeploymentState(path)
+    state.record('roles', module['roles'], sha='b' * 40, duration=1.5, status='ok')
+    state.record('base', {'url': url, 'ref': 'production'}, sha='c' * 40, duration=1, status='ok')
+    state.record('broken', {'url': url, 'ref': 'production'}, sha=None, duration=1, status='failed')
+    state.save()
+
+    modules = dict(module)
+    modules['broken'] = {'url': url, 'ref': 'production'}
+    modules['other'] = {'url': url, 'ref': 'production'}
+
+    actual = postrun.DeploymentState(path).classify(modules, {(url, 'production'): 'b' * 40})
+
+    assert(actual == {'unchanged': ['roles'], 'updated': ['broken'], 'new': ['other'], 'removed': ['base']})
+
+
+@pytest.mark.deploy
+@mock.patch('os.path.isdir', return_value=True)
+@mock.patch('postrun.clone_module')
+def test_moduledeployer_deploy_modules_unchanged(mock_clone, mock_dir, module):
+    """
+    Test that unchanged modules are skipped
+    """
+
+    url = 'https://github.com/vision-it/puppet-roles.git'
+    mock_logger = mock.MagicMock()
+    mock_state = mock.MagicMock()
+    mock_state.classify.return_value = {'unchanged': ['roles'], 'updated': [], 'new': [], 'removed': []}
+
+    md = postrun.ModuleDeployer(dir_path='/tmp',
+                                is_vagrant=False,
+                                logger=mock_logger,
+                                modules=module,
+                                environment='foobar',
+                                resolved={(url, 'production'): 'b' * 40},
+                                state=mock_state)
+
+    assert(md.deploy_modules() == True)
+    mock_clone.assert_not_called()
+    mock_state.save.assert_called_once_with()
+
+
+@pytest.mark.deploy
+def test_module_delta():
+    """
+    Test the module level difference of two configurations
+    """
+
+    url = 'https://github.com/vision-it/puppet-roles.git'
+    previous = {'roles': {'url': url, 'ref': 'production'},
+                'base': {'url': url, 'ref': 'production'},
+                'ntp': {'url': url, 'ref': 'production'},
+                'old': {'url': url, 'ref': 'production'}}
+    current = {'roles': {'url': url, 'ref': 'production'},
+               'base': {'url': 'https://github.com/other/base.git', 'ref': 'production'},
+               'ntp': {'url': url, 'ref': 'master'},
+               'new': {'url': url, 'ref': 'production'}}
+
+    actual = postrun.module_delta(previous, current)
+
+    assert(actual == {'added': ['new'], 'removed': ['old'], 'url_changed': ['base'], 'ref_changed': ['ntp']})
+
+
+@pytest.mark.deploy
+@pytest.mark.parametrize('partial', [False, True])
+@mock.patch('postrun.clone_module')
+def test_moduledeployer_remove_dropped(mock_clone, partial, tmpdir):
+    """
+    Test that dropped modules are removed, unless only some modules are deployed
+    """
+
+    url = 'https://github.com/vision-it/puppet-roles.git'
+    tmpdir.join('dist', 'old', '.git').ensure(dir=True)
+
+    state = postrun.DeploymentState(str(tmpdir.join('state.json')))
+    state.record('old', {'url': url, 'ref': 'production'}, sha='b' * 40, duration=1, status='ok')
+
+    mock_logger = mock.MagicMock()
+    md = postrun.ModuleDeployer(dir_path=str(tmpdir.join('dist')),
+                                is_vagrant=False,
+                                logger=mock_logger,
+                                modules={},
+                                environment='foobar',
+                                state=state,
+                                partial=partial)
+
+    assert(md.deploy_modules() == True)
+    assert(tmpdir.join('dist', 'old').check() == partial)
+    assert(('old' in postrun.DeploymentState(str(tmpdir.join('state.json'))).modules) == partial)
+
+
+@pytest.mark.deploy
+def test_module_store(tmpdir):
+    """
+    Test that modules are stored once, linked into dist and garbage collected
+    """
+
+    repo = tmpdir.join('upstream')
+    subprocess.check_call(['git', 'init', '-q', '-b', 'production', str(repo)])
+    repo.join('metadata.json').write('{}')
+    subprocess.check_call(['git', '-C', str(repo), 'add', '-A'])
+    subprocess.check_call(['git', '-C', str(repo), '-c', 'user.name=postrun', '-c', 'user.email=postrun@localhost',
+                           'commit', '-q', '-m', 'initial'])
+    sha = subprocess.check_output(['git', '-C', str(repo), 'rev-parse', 'HEAD']).decode('utf-8').strip()
+
+    url = 'file://' + str(repo)
+    modules = {'roles': {'url': url, 'ref': 'production'}}
+    mock_logger = mock.MagicMock()
+    store = postrun.ModuleStore(str(tmpdir.join('store')), mock_logger)
+
+    for env in ['production', 'staging']:
+        md = postrun.ModuleDeployer(dir_path=str(tmpdir.join(env)),
+                                    is_vagrant=False,
+                                    logger=mock_logger,
+                                    modules=modules,
+                                    environment=env,
+                                    resolved={(url, 'production'): sha},
+                                    store=store)
+        assert(md.deploy_modules() == True)
+        assert(md.validate_deployment() == True)
+
+    module = ('roles', modules['roles'])
+    assert(os.path.realpath(str(tmpdir.join('production', 'roles'))) == store.path(module, sha))
+    assert(os.path.realpath(str(tmpdir.join('staging', 'roles'))) == store.path(module, sha))
+    assert(store.path(module, sha, sparse=True) != store.path(module, sha))
+    assert(store.path(module, sha, blobless=True) != store.path(module, sha))
+    assert(not store.contains(module, sha, sparse=True))
+
+    dist_dirs = [str(tmpdir.join('production')), str(tmpdir.join('staging'))]
+    assert(store.collect_garbage(dist_dirs) == {store.path(module, sha): 2})
+    assert(store.contains(module, sha))
+
+    os.remove(str(tmpdir.join('production', 'roles')))
+    os.remove(str(tmpdir.join('staging', 'roles')))
+
+    # Trees of a run that hasn't linked them yet are kept
+    with store.shared():
+        collector = threading.Thread(target=store.collect_garbage, args=(dist_dirs,))
+        collector.start()
+        collector.join(0.5)
+        assert(collector.is_alive())
+        assert(store.contains(module, sha))
+
+    collector.join()
+    assert(not store.contains(module, sha))
+
+
+@pytest.mark.deploy
+def test_moduledeployer_validate_sha(tmpdir):
+    """
+    Test that validation compares HEAD with the resolved commit in parallel and resolves again on a mismatch
+    """
+
+    url = 'https://github.com/vision-it/puppet-roles.git'
+    modules = {'roles': {'url': url, 'ref': 'production'}, 'base': {'url': url, 'ref': 'production'}}
+    for name in modules:
+        tmpdir.join(name, '.git', 'HEAD').write('a' * 40, ensure=True)
+
+    mock_logger = mock.MagicMock()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        md = postrun.ModuleDeployer(dir_path=str(tmpdir),
+                                    is_vagrant=False,
+                                    logger=mock_logger,
+                                    modules=modules,
+                                    resolved={(url, 'production'): 'a' * 40},
+                                    executor=executor)
+        with mock.patch('postrun.resolve_refs') as mock_resolve:
+            assert(md.validate_deployment() == True)
+            mock_resolve.assert_not_called()
+
+        tmpdir.join('base', '.git', 'HEAD').write('c' * 40)
+
+        # The ref moved on to the deployed commit after it was resolved
+        with mock.patch('postrun.resolve_refs', return_value={(url, 'production'): 'c' * 40}):
+            assert(md.validate_deployment() == True)
+
+        with mock.patch('postrun.resolve_refs', return_value={(url, 'production'): 'b' * 40}):
+            assert(md.validate_deployment() == False)
+
+    mock_logger.error.assert_called_once_with('%s is at %s instead of %s', 'base', 'c' * 40, 'b' * 40)
+
+
+@pytest.mark.deploy
+@mock.patch('postrun.clone_module')
+def test_moduledeployer_host_unavailable(mock_clone, module, tmpdir):
+    """
+    Test that modules of a host with an open circuit breaker fail fast and keep their checkout
+    """
+
+    tmpdir.join('roles', '.git', 'HEAD').write('a' * 40, ensure=True)
+    mock_logger = mock.MagicMock()
+    md = postrun.ModuleDeployer(dir_path=str(tmpdir),
+                                is_vagrant=False,
+                                logger=mock_logger,
+                                modules=module)
+
+    with mock.patch('postrun.RETRY_POLICY', postrun.RetryPolicy(failures=1)) as policy:
+        policy.record('github.com', success=False)
+        assert(md.checkout_git(list(module.items())[0]) == False)
+
+    mock_clone.assert_not_called()
+    assert(tmpdir.join('roles', '.git', 'HEAD').check())
+
+
+@pytest.mark.deploy
+@mock.patch('postrun.clone_module', return_value=False)
+@pytest.mark.parametrize('partial', [False, True])
+def test_moduledeployer_prune(mock_clone, partial, module, tmpdir):
+    """
+    Test that entries of dist that are no configured module are moved out and deleted in the background
+    """
+
+    tmpdir.join('dist', 'roles', '.git').ensure(dir=True)
+    tmpdir.join('dist', 'stale', 'manifests', 'init.pp').write('', ensure=True)
+    tmpdir.join('dist', '.postrun', 'staging').ensure(dir=True)
+    os.symlink(str(tmpdir.join('elsewhere')), str(tmpdir.join('dist', 'dangling')))
+
+    mock_logger = mock.MagicMock()
+    md = postrun.ModuleDeployer(dir_path=str(tmpdir.join('dist')),
+                                is_vagrant=False,
+                                logger=mock_logger,
+                                modules=module,
+                                partial=partial,
+                                prune=True)
+
+    md.deploy_modules()
+    md.trash.wait()
+
+    expected = ['.postrun', 'dangling', 'roles', 'stale'] if partial else ['.postrun', 'roles']
+    assert(sorted(os.listdir(str(tmpdir.join('dist')))) == expected)
+    assert(not tmpdir.join('dist', '.postrun', 'discarded').check() or
+           tmpdir.join('dist', '.postrun', 'discarded').listdir() == [])
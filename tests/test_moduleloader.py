@@ -83,7 +83,7 @@ def test_moduleload_with_branch():
 
 def test_moduleloader_no_file():
     """
-    Test if empty dict is returned if no modules.yaml is available
+    Test if None is returned if no modules.yaml is available
     """
 
     mock_logger = mock.MagicMock()
@@ -93,4 +93,65 @@ def test_moduleloader_no_file():
 
     loaded_mod = ml.get_modules()
 
-    assert(loaded_mod == {})
+    assert(loaded_mod == None)
+
+
+def test_moduleloader_unusable_file(tmpdir):
+    """
+    Test if None is returned if the modules.yaml has no modules, but an empty dict for an empty list
+    """
+
+    mock_logger = mock.MagicMock()
+    modules_file = tmpdir.join('production', 'modules.yaml')
+
+    def loader():
+        return postrun.ModuleLoader(dir_path=str(tmpdir), logger=mock_logger, location='real_loc')
+
+    for content in ["modules: [", "", "foo: bar\n", "modules:\n  other: {}\n"]:
+        modules_file.write(content, ensure=True)
+        assert(loader().get_modules() == None)
+
+    modules_file.write("modules:\n  default: {}\n")
+    assert(loader().get_modules() == {})
+
+
+def test_moduleloader_fingerprint():
+    """
+    Test that the fingerprint depends on the modules file and the location
+    """
+
+    mock_logger = mock.MagicMock()
+    directory = os.path.dirname(os.path.realpath(__file__))
+
+    default = postrun.ModuleLoader(dir_path=directory, logger=mock_logger, environment='', location='default')
+    other = postrun.ModuleLoader(dir_path=directory, logger=mock_logger, environment='', location='real_loc')
+    missing = postrun.ModuleLoader(dir_path='/foobar', logger=mock_logger)
+
+    assert(len(default.fingerprint()) == 64)
+    assert(default.fingerprint() != other.fingerprint())
+    assert(missing.fingerprint() == None)
+
+
+def test_moduleloader_parsed_cache(tmpdir):
+    """
+    Test that an unchanged modules file is loaded from the cache
+    """
+
+    mock_logger = mock.MagicMock()
+    tmpdir.join('production', 'modules.yaml').write("modules:\n  default:\n    roles:\n      url: 'a'\n      ref: 'b'\n",
+                                                    ensure=True)
+
+    def loader():
+        return postrun.ModuleLoader(dir_path=str(tmpdir),
+                                    logger=mock_logger,
+                                    cache_dir=str(tmpdir.join('cache')))
+
+    expected = {'roles': {'url': 'a', 'ref': 'b'}}
+    assert(loader().get_modules() == expected)
+
+    with mock.patch('yaml.load') as mock_load:
+        assert(loader().get_modules() == expected)
+        mock_load.assert_not_called()
+
+    tmpdir.join('production', 'modules.yaml').write("modules:\n  default: {}\n")
+    assert(loader().get_modules() == {})
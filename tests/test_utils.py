@@ -2,9 +2,15 @@
 
 
 import pytest
+import concurrent.futures
+import io
+import json
 import os
 import unittest.mock as mock
 import subprocess
+import sys
+import threading
+import time
 
 import postrun
 
@@ -61,8 +67,8 @@ def test_rmdir_link(mock_islink, mock_path, mock_rm, mock_rmtree,  module):
 
 
 @pytest.mark.utils
-@mock.patch('subprocess.check_call')
-def test_clone_module(mock_call):
+@mock.patch('postrun.GIT_RUNNER.run')
+def test_clone_module(mock_run):
     """
     Test that clone_module calls git
     """
@@ -72,24 +78,19 @@ def test_clone_module(mock_call):
     module = ('roles',
               {'url': 'https://github.com/vision-it/puppet-roles.git', 'ref': 'production'})
 
-    process_mock = mock.Mock()
-    attrs = {'return_value': (b'output', b'error')}
-    process_mock.configure_mock(**attrs)
-    mock_call.return_value = process_mock
+    mock_run.return_value = b'output'
 
     postrun.clone_module(module, '/foobar', mock_logger)
 
-    mock_call.assert_called_once_with(['git',
-                                       'clone',
-                                       '--depth',
-                                       '1',
-                                       'https://github.com/vision-it/puppet-roles.git',
-                                       '-b',
-                                       'production',
-                                       '/foobar/roles'],
-                                      stderr=-1,
-                                      stdout=-1,
-                                      timeout=30)
+    mock_run.assert_called_once_with(['git',
+                                      'clone',
+                                      '--progress',
+                                      '--depth',
+                                      '1',
+                                      'https://github.com/vision-it/puppet-roles.git',
+                                      '-b',
+                                      'production',
+                                      '/foobar/roles'])
 
 
 @pytest.mark.utils
@@ -129,6 +130,25 @@ def test_get_location_exception(mock_popen):
     assert(location == 'default')
 
 
+@pytest.mark.utils
+@mock.patch('subprocess.check_output')
+def test_get_location_default_not_cached(mock_popen, tmpdir):
+    """
+    Test that the default location isn't cached if facter fails
+    """
+
+    facts = str(tmpdir.join('facts.d'))
+    mock_popen.side_effect = subprocess.CalledProcessError(1, 'foo')
+
+    assert(postrun.get_location(cache_dir=str(tmpdir), facts_dirs=[facts], cached_facts_dir=facts) == 'default')
+    assert(not tmpdir.join('location').check())
+
+    mock_popen.side_effect = None
+    mock_popen.return_value = b'output'
+    assert(postrun.get_location(cache_dir=str(tmpdir), facts_dirs=[facts], cached_facts_dir=facts) == 'output')
+    assert(tmpdir.join('location').read() == 'output')
+
+
 @pytest.mark.utils
 @mock.patch('subprocess.check_output', return_value=b'output')
 def test_get_location(mock_popen):
@@ -141,3 +161,864 @@ def test_get_location(mock_popen):
     mock_popen.assert_called_once_with(['/opt/puppetlabs/bin/facter', 'location'])
 
     assert(location == 'output')
+
+
+@pytest.mark.utils
+def test_remote_host():
+    """
+    Test host extraction for the supported URL styles
+    """
+
+    assert(postrun.remote_host('https://github.com/vision-it/puppet-roles.git') == 'github.com')
+    assert(postrun.remote_host('ssh://git@gitlab.example.com:2222/roles.git') == 'gitlab.example.com')
+    assert(postrun.remote_host('git@github.com:vision-it/puppet-roles.git') == 'github.com')
+    assert(postrun.remote_host('/srv/git/roles.git') == '')
+
+
+@pytest.mark.utils
+def test_host_limiter_caps_per_host():
+    """
+    Test that the HostLimiter shares one semaphore per host
+    """
+
+    limiter = postrun.HostLimiter(max_per_host=1)
+
+    with limiter.limit('https://github.com/a.git'):
+        semaphore = limiter.semaphores['github.com']
+        assert(semaphore.acquire(blocking=False) == False)
+        with limiter.limit('https://gitlab.com/b.git'):
+            pass
+
+    assert(semaphore.acquire(blocking=False) == True)
+
+
+@pytest.mark.utils
+@mock.patch('os.path.isdir', return_value=True)
+@mock.patch('postrun.git')
+@mock.patch('postrun.git_output')
+def test_update_module_unchanged(mock_output, mock_git, mock_dir, module):
+    """
+    Test that an up to date checkout is only fetched
+    """
+
+    mock_logger = mock.MagicMock()
+    mock_output.side_effect = ['https://github.com/vision-it/puppet-roles.git', 'abc', 'abc']
+
+    actual = postrun.update_module(list(module.items())[0], '/foobar', mock_logger)
+
+    assert(actual == True)
+    mock_git.assert_called_once_with('-C', '/foobar/roles', 'fetch', '--progress', '--depth', '1', 'origin', 'production')
+
+
+@pytest.mark.utils
+@mock.patch('os.path.isdir', return_value=True)
+@mock.patch('postrun.git')
+@mock.patch('postrun.git_output')
+def test_update_module_changed(mock_output, mock_git, mock_dir, module):
+    """
+    Test that a changed ref resets the checkout
+    """
+
+    mock_logger = mock.MagicMock()
+    mock_output.side_effect = ['https://github.com/vision-it/puppet-roles.git', 'def', 'abc']
+
+    actual = postrun.update_module(list(module.items())[0], '/foobar', mock_logger)
+
+    assert(actual == True)
+    mock_git.assert_any_call('-C', '/foobar/roles', 'reset', '--hard', 'def')
+
+
+@pytest.mark.utils
+@mock.patch('os.path.isdir', return_value=True)
+@mock.patch('postrun.git')
+@mock.patch('postrun.git_output', return_value='https://github.com/other/repo.git')
+def test_update_module_url_changed(mock_output, mock_git, mock_dir, module):
+    """
+    Test that a changed URL requires a fresh clone
+    """
+
+    mock_logger = mock.MagicMock()
+
+    actual = postrun.update_module(list(module.items())[0], '/foobar', mock_logger)
+
+    assert(actual == False)
+    mock_git.assert_not_called()
+
+
+@pytest.mark.utils
+@mock.patch('os.path.isdir', return_value=True)
+@mock.patch('postrun.git_output', side_effect=subprocess.CalledProcessError(128, 'git'))
+def test_update_module_corrupt(mock_output, mock_dir, module):
+    """
+    Test that a corrupt checkout requires a fresh clone
+    """
+
+    mock_logger = mock.MagicMock()
+
+    actual = postrun.update_module(list(module.items())[0], '/foobar', mock_logger)
+
+    assert(actual == False)
+
+
+@pytest.mark.utils
+def test_normalize_url():
+    """
+    Test that different spellings of an URL normalize to the same value
+    """
+
+    expected = 'https://github.com/vision-it/puppet-roles'
+
+    assert(postrun.normalize_url('https://GitHub.com/vision-it/puppet-roles.git') == expected)
+    assert(postrun.normalize_url('https://github.com/vision-it/puppet-roles/') == expected)
+    assert(postrun.normalize_url('git@GitHub.com:vision-it/Roles.git') == 'git@github.com:vision-it/Roles')
+
+
+@pytest.fixture
+def git_repo(tmpdir):
+
+    repo = tmpdir.join('upstream')
+    subprocess.check_call(['git', 'init', '-q', '-b', 'production', str(repo)])
+    repo.join('metadata.json').write('{}')
+    subprocess.check_call(['git', '-C', str(repo), 'add', '-A'])
+    subprocess.check_call(['git', '-C', str(repo), '-c', 'user.name=postrun', '-c', 'user.email=postrun@localhost',
+                           'commit', '-q', '-m', 'initial'])
+    return repo
+
+
+@pytest.mark.utils
+def test_mirror_cache_clone(git_repo, tmpdir):
+    """
+    Test that modules are cloned from the mirror and the mirror is fetched once
+    """
+
+    mock_logger = mock.MagicMock()
+    url = 'file://' + str(git_repo)
+    cache = postrun.MirrorCache(str(tmpdir.join('mirrors')), mock_logger)
+
+    source = cache.update(url)
+
+    assert(source == 'file://' + cache.path(url))
+    assert(os.path.isdir(cache.path(url)))
+
+    with mock.patch('postrun.git') as mock_git:
+        assert(cache.update(url) == source)
+        mock_git.assert_not_called()
+
+    module = ('roles', {'url': url, 'ref': 'production'})
+    assert(postrun.clone_module(module, str(tmpdir.join('dist')), mock_logger, source=source) == True)
+
+    origin = subprocess.check_output(['git', '-C', str(tmpdir.join('dist', 'roles')), 'config', 'remote.origin.url'])
+    assert(origin.decode('utf-8').strip() == url)
+
+
+@pytest.mark.utils
+def test_mirror_cache_waits_for_other_process(git_repo, tmpdir):
+    """
+    Test that the mirror isn't touched while another process holds its lock
+    """
+
+    url = 'file://' + str(git_repo)
+    cache = postrun.MirrorCache(str(tmpdir.join('mirrors')), mock.MagicMock())
+    tmpdir.join('mirrors').ensure(dir=True)
+    result = []
+
+    with postrun.file_lock(cache.path(url) + '.lock'):
+        thread = threading.Thread(target=lambda: result.append(cache.update(url)))
+        thread.start()
+        thread.join(0.5)
+        assert(thread.is_alive())
+        assert(not os.path.exists(cache.path(url)))
+
+    thread.join()
+    assert(result == ['file://' + cache.path(url)])
+
+
+@pytest.mark.utils
+def test_lookup_ref():
+    """
+    Test that refs resolve like git clone -b would
+    """
+
+    refs = postrun.parse_ls_remote('a' * 40 + '\tHEAD\n' +
+                                   'b' * 40 + '\trefs/heads/production\n' +
+                                   'c' * 40 + '\trefs/tags/v1.0\n' +
+                                   'd' * 40 + '\trefs/tags/v1.0^{}\n')
+
+    assert(postrun.lookup_ref(refs, 'production') == 'b' * 40)
+    assert(postrun.lookup_ref(refs, 'v1.0') == 'd' * 40)
+    assert(postrun.lookup_ref(refs, 'e' * 40) == 'e' * 40)
+    assert(postrun.lookup_ref(refs, 'notabranch') == None)
+
+
+@pytest.mark.utils
+@mock.patch('postrun.git_output')
+def test_resolve_refs_once_per_url(mock_output):
+    """
+    Test that each URL is only asked once
+    """
+
+    mock_logger = mock.MagicMock()
+    mock_output.return_value = 'b' * 40 + '\trefs/heads/production\n' + 'c' * 40 + '\trefs/heads/master\n'
+    modules = [{'url': 'https://github.com/vision-it/puppet-roles.git', 'ref': 'production'},
+               {'url': 'https://github.com/vision-it/puppet-roles.git', 'ref': 'master'},
+               {'url': 'https://github.com/vision-it/puppet-roles.git', 'ref': 'production'}]
+
+    resolved = postrun.resolve_refs(modules, mock_logger)
+
+    mock_output.assert_called_once_with('ls-remote', 'https://github.com/vision-it/puppet-roles.git')
+    assert(resolved == {('https://github.com/vision-it/puppet-roles.git', 'production'): 'b' * 40,
+                        ('https://github.com/vision-it/puppet-roles.git', 'master'): 'c' * 40})
+
+
+@pytest.mark.utils
+def test_swap_directory(tmpdir):
+    """
+    Test that the new directory replaces the old one
+    """
+
+    tmpdir.join('staging', 'roles', 'new').ensure()
+    tmpdir.join('dist', 'roles', 'old').ensure()
+
+    postrun.swap_directory(str(tmpdir.join('staging', 'roles')),
+                           str(tmpdir.join('dist', 'roles')),
+                           str(tmpdir.join('trash')))
+
+    assert(os.listdir(str(tmpdir.join('dist', 'roles'))) == ['new'])
+    assert(os.listdir(str(tmpdir.join('trash'))) == [])
+
+
+@pytest.mark.utils
+@mock.patch('subprocess.check_output')
+def test_get_location_override(mock_popen, tmpdir):
+    """
+    Test that an override wins over everything else
+    """
+
+    assert(postrun.get_location(override='berlin', cache_dir=str(tmpdir)) == 'berlin')
+
+    with mock.patch.dict('os.environ', {'POSTRUN_LOCATION': 'munich'}):
+        assert(postrun.get_location(cache_dir=str(tmpdir)) == 'munich')
+
+    mock_popen.assert_not_called()
+
+
+@pytest.mark.utils
+@mock.patch('subprocess.check_output', return_value=b'output\n')
+def test_get_location_cached(mock_popen, tmpdir):
+    """
+    Test that the facter result is cached
+    """
+
+    facts = str(tmpdir.join('facts.d'))
+
+    assert(postrun.get_location(cache_dir=str(tmpdir), facts_dirs=[facts], cached_facts_dir=facts) == 'output')
+    assert(postrun.get_location(cache_dir=str(tmpdir), facts_dirs=[facts], cached_facts_dir=facts) == 'output')
+    assert(mock_popen.call_count == 1)
+
+    assert(postrun.get_location(cache_dir=str(tmpdir), ttl=0, facts_dirs=[facts], cached_facts_dir=facts) == 'output')
+    assert(mock_popen.call_count == 2)
+
+
+@pytest.mark.utils
+@mock.patch('subprocess.check_output')
+def test_get_location_fact_files(mock_popen, tmpdir):
+    """
+    Test that external facts and Puppet's cached facts are read without facter
+    """
+
+    tmpdir.join('facts.d', 'location.txt').write('location=berlin\n', ensure=True)
+    assert(postrun.get_location(facts_dirs=[str(tmpdir.join('facts.d'))]) == 'berlin')
+
+    tmpdir.join('cache', 'node.yaml').write('--- !ruby/object:Puppet::Node::Facts\n'
+                                            'name: node\n'
+                                            'values:\n'
+                                            '  location: munich\n', ensure=True)
+    assert(postrun.read_fact_file(str(tmpdir.join('cache', 'node.yaml')), 'location') == 'munich')
+
+    mock_popen.assert_not_called()
+
+
+@pytest.mark.utils
+def test_metrics_reports(tmpdir):
+    """
+    Test that metrics are written as JSON and Prometheus textfile
+    """
+
+    metrics = postrun.Metrics()
+    with metrics.phase('load'):
+        pass
+    metrics.start_environment('production')
+    metrics.record_module('production', 'roles', 'https://github.com/vision-it/puppet-roles.git',
+                          duration=3.0, size=4096, retries=0, outcome='failed')
+    # Deployed again by a follow-up pass
+    metrics.record_module('production', 'roles', 'https://github.com/vision-it/puppet-roles.git',
+                          duration=1.5, size=2048, retries=1, outcome='ok')
+    metrics.finish_environment('production', 'ok')
+
+    metrics.write_json(str(tmpdir.join('metrics.json')), success=True)
+    metrics.write_textfile(str(tmpdir.join('postrun.prom')), success=True)
+
+    report = postrun.read_json(str(tmpdir.join('metrics.json')))
+    assert(list(report['phases']) == ['load'])
+    assert(report['environments']['production']['outcome'] == 'ok')
+    assert(len(report['modules']) == 1)
+    assert(report['modules'][0]['bytes'] == 2048)
+
+    textfile = tmpdir.join('postrun.prom').read()
+    assert('postrun_success 1\n' in textfile)
+    assert('postrun_module_bytes{environment="production",module="roles"} 2048\n' in textfile)
+    assert('postrun_module_retries{environment="production",module="roles"} 1\n' in textfile)
+    assert(textfile.count('postrun_module_success{environment="production",module="roles"}') == 1)
+
+
+@pytest.mark.utils
+def test_tracer_spans(tmpdir):
+    """
+    Test that spans are written as Chrome trace events with thread names
+    """
+
+    tracer = postrun.Tracer()
+    with tracer.span('disabled'):
+        pass
+
+    tracer.enable(profiling=True)
+    with tracer.span('outer', environment='production'):
+        with tracer.span('inner', module='roles'):
+            pass
+
+    tracer.write(str(tmpdir.join('trace.json')), str(tmpdir.join('profile.stats')))
+
+    events = postrun.read_json(str(tmpdir.join('trace.json')))['traceEvents']
+    spans = [event for event in events if event['ph'] == 'X']
+
+    assert([event['name'] for event in spans] == ['inner', 'outer'])
+    assert(spans[1]['args'] == {'environment': 'production'})
+    assert(spans[0]['ts'] >= spans[1]['ts'])
+    assert(any(event['ph'] == 'M' for event in events))
+    assert(tmpdir.join('profile.stats').check())
+
+
+@pytest.mark.utils
+def test_tracer_profiling_unavailable():
+    """
+    Test that a thread that can't run under cProfile is still traced, without stats
+    """
+
+    tracer = postrun.Tracer()
+    tracer.enable(profiling=True)
+
+    with mock.patch('cProfile.Profile.enable', side_effect=ValueError('Another profiling tool is already active')):
+        with tracer.span('job', module='roles'):
+            pass
+
+    assert([event['name'] for event in tracer.events] == ['job'])
+    assert(tracer.profiles == [])
+
+    # Concurrent profiling is refused since Python 3.12
+    results = []
+
+    def worker():
+        with tracer.span('worker'):
+            results.append(True)
+
+    with tracer.span('main'):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+
+    assert(results == [True])
+    assert(sorted(event['name'] for event in tracer.events) == ['job', 'main', 'worker'])
+
+
+@pytest.mark.utils
+def test_clone_module_sparse(git_repo, tmpdir):
+    """
+    Test that a sparse partial clone only checks out the Puppet paths
+    """
+
+    git_repo.join('manifests', 'init.pp').write('class roles {}', ensure=True)
+    git_repo.join('spec', 'roles_spec.rb').write('', ensure=True)
+    subprocess.check_call(['git', '-C', str(git_repo), 'add', '-A'])
+    subprocess.check_call(['git', '-C', str(git_repo), '-c', 'user.name=postrun', '-c', 'user.email=postrun@localhost',
+                           'commit', '-q', '-m', 'module'])
+    subprocess.check_call(['git', '-C', str(git_repo), 'config', 'uploadpack.allowFilter', 'true'])
+
+    mock_logger = mock.MagicMock()
+    module = ('roles', {'url': 'file://' + str(git_repo), 'ref': 'production', 'partial': True})
+
+    assert(postrun.clone_module(module, str(tmpdir.join('dist')), mock_logger, sparse=True) == True)
+
+    checkout = tmpdir.join('dist', 'roles')
+    assert(checkout.join('manifests', 'init.pp').check())
+    assert(checkout.join('metadata.json').check())
+    assert(not checkout.join('spec').check())
+
+    config = subprocess.check_output(['git', '-C', str(checkout), 'config', 'remote.origin.partialclonefilter'])
+    assert(config.decode('utf-8').strip() == 'blob:none')
+
+
+@pytest.mark.utils
+@mock.patch('postrun.git')
+def test_clone_module_sparse_paths(mock_git):
+    """
+    Test that the sparse paths of a module are used
+    """
+
+    mock_logger = mock.MagicMock()
+    module = ('roles', {'url': 'https://github.com/vision-it/puppet-roles.git', 'ref': 'production',
+                        'sparse': ['manifests']})
+
+    postrun.clone_module(module, '/foobar', mock_logger)
+
+    mock_git.assert_any_call('clone', '--progress', '--depth', '1', '--sparse', 'https://github.com/vision-it/puppet-roles.git',
+                             '-b', 'production', '/foobar/roles')
+    mock_git.assert_any_call('-C', '/foobar/roles', 'sparse-checkout', 'set', 'manifests')
+
+
+def rev_parse(directory):
+
+    output = subprocess.check_output(['git', '-C', str(directory), 'rev-parse', 'HEAD'])
+    return output.decode('utf-8').strip()
+
+
+@pytest.mark.utils
+def test_read_git_head(git_repo, tmpdir):
+    """
+    Test that HEAD is read from loose refs, packed refs, detached HEADs and worktrees
+    """
+
+    sha = rev_parse(git_repo)
+    assert(postrun.read_git_head(str(git_repo)) == sha)
+
+    subprocess.check_call(['git', '-C', str(git_repo), 'pack-refs', '--all'])
+    assert(not git_repo.join('.git', 'refs', 'heads', 'production').check())
+    assert(postrun.read_git_head(str(git_repo)) == sha)
+
+    worktree = tmpdir.join('worktree')
+    subprocess.check_call(['git', '-C', str(git_repo), 'worktree', 'add', '-q', '--detach', str(worktree)])
+    assert(worktree.join('.git').check(file=1))
+    assert(postrun.read_git_head(str(worktree)) == sha)
+
+
+@pytest.mark.utils
+def test_read_git_head_invalid(tmpdir):
+    """
+    Test that directories without a readable HEAD return None
+    """
+
+    assert(postrun.read_git_head(str(tmpdir.join('missing'))) is None)
+
+    tmpdir.join('broken', '.git', 'HEAD').write('ref: refs/heads/production', ensure=True)
+    assert(postrun.read_git_head(str(tmpdir.join('broken'))) is None)
+
+
+@pytest.mark.utils
+def test_environment_lock_follow_up(tmpdir):
+    """
+    Test that runs arriving mid-run cause exactly one follow-up pass
+    """
+
+    active = postrun.EnvironmentLock(str(tmpdir), 'production')
+    assert(active.acquire() == 'locked')
+
+    assert(postrun.EnvironmentLock(str(tmpdir), 'production').acquire() == 'deferred')
+    assert(postrun.EnvironmentLock(str(tmpdir), 'production').acquire() == 'deferred')
+    assert(active.finish() == True)
+
+    assert(active.finish() == False)
+    assert(postrun.EnvironmentLock(str(tmpdir), 'production').acquire() == 'locked')
+
+
+@pytest.mark.utils
+def test_environment_lock_wait_during_follow_up(tmpdir):
+    """
+    Test that runs arriving during the follow-up pass wait and are coalesced into one more pass
+    """
+
+    active = postrun.EnvironmentLock(str(tmpdir), 'production')
+    active.acquire()
+    postrun.EnvironmentLock(str(tmpdir), 'production').acquire()
+    assert(active.finish() == True)
+
+    results = []
+
+    def waiter():
+        lock = postrun.EnvironmentLock(str(tmpdir), 'production')
+        results.append(lock.acquire())
+        lock.release()
+
+    threads = [threading.Thread(target=waiter) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+
+    requested = 0
+    while requested < 3:
+        time.sleep(0.01)
+        with postrun.EnvironmentLock(str(tmpdir), 'production').counters() as counters:
+            requested = counters['requested']
+    assert(results == [])
+
+    assert(active.finish() == False)
+    for thread in threads:
+        thread.join()
+
+    assert(sorted(results) == ['covered', 'locked'])
+
+
+@pytest.mark.utils
+def test_environment_lock_no_defer(tmpdir):
+    """
+    Test that a run a follow-up pass doesn't cover waits for the lock instead of deferring
+    """
+
+    active = postrun.EnvironmentLock(str(tmpdir), 'production')
+    active.acquire()
+    results = []
+
+    def waiter():
+        lock = postrun.EnvironmentLock(str(tmpdir), 'production')
+        results.append(lock.acquire(defer=False))
+        results.append(lock.finish())
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    thread.join(0.2)
+    assert(results == [])
+
+    assert(postrun.EnvironmentLock(str(tmpdir), 'production').acquire() == 'deferred')
+    assert(active.finish() == True)
+    assert(active.finish() == False)
+
+    thread.join()
+    assert(results == ['locked', False])
+
+
+@pytest.mark.utils
+@mock.patch('postrun.EnvironmentLock.acquire', return_value='locked')
+def test_lock_environments_defer(mock_acquire, tmpdir):
+    """
+    Test that only runs a complete pass covers defer to the active run
+    """
+
+    for options, defer in [([], True), (['--changed-repo', 'x'], True), (['-m', 'roles', '-b', 'feature'], False),
+                           (['--force'], False)]:
+        args = postrun.commandline(['--cache-dir', str(tmpdir)] + options)
+        postrun.lock_environments(args, ['production'], mock.MagicMock(), postrun.Metrics())
+        mock_acquire.assert_called_with(defer=defer)
+
+
+@pytest.mark.utils
+def test_match_changed_repo():
+    """
+    Test that changed repositories are matched by URL and ref, also for SSH URLs
+    """
+
+    environment_modules = {
+        'production': {'roles': {'url': 'git@github.com:vision-it/puppet-roles.git', 'ref': 'production'},
+                       'base': {'url': 'https://github.com/vision-it/puppet-base.git', 'ref': 'production'}},
+        'feature': {'roles': {'url': 'git@github.com:vision-it/puppet-roles.git', 'ref': 'feature'}}}
+    index = postrun.build_module_index(environment_modules)
+
+    roles = 'git@github.com:vision-it/puppet-roles'
+    assert(sorted(index[(roles, 'feature')]) == [('feature', 'roles')])
+    assert(sorted(postrun.match_changed_repo('git@github.com:vision-it/puppet-roles.git', index)) ==
+           [(roles, 'feature'), (roles, 'production')])
+    assert(postrun.match_changed_repo('git@github.com:vision-it/puppet-roles.git@feature', index) ==
+           [(roles, 'feature')])
+    assert(postrun.match_changed_repo('https://GITHUB.com/vision-it/puppet-base/@refs/heads/production', index) ==
+           [('https://github.com/vision-it/puppet-base', 'production')])
+    assert(postrun.match_changed_repo('https://github.com/vision-it/puppet-base@master', index) == [])
+    assert(postrun.match_changed_repo('https://github.com/vision-it/puppet-unknown', index) is None)
+
+    targets = postrun.changed_modules([roles + '@feature', 'https://github.com/vision-it/puppet-base'],
+                                      environment_modules, mock.MagicMock())
+    assert(targets == {'feature': {'roles'}, 'production': {'base'}})
+
+
+@pytest.mark.utils
+def test_read_changed_repos():
+    """
+    Test that - reads the changed repositories from stdin
+    """
+
+    stdin = io.StringIO('https://github.com/vision-it/puppet-roles.git@production\n\nhttps://github.com/vision-it/puppet-base.git\n')
+
+    assert(postrun.read_changed_repos(['foo', '-'], stdin=stdin) ==
+           ['foo', 'https://github.com/vision-it/puppet-roles.git@production', 'https://github.com/vision-it/puppet-base.git'])
+
+
+@pytest.mark.utils
+def test_git_runner():
+    """
+    Test that the runner returns stdout and raises on failures
+    """
+
+    runner = postrun.GitRunner(stall_timeout=5)
+
+    assert(runner.run(['git', '--version']).startswith(b'git version'))
+
+    with pytest.raises(subprocess.CalledProcessError) as exp:
+        runner.run(['git', 'no-such-command'], stall_timeout=5)
+    assert(exp.value.returncode != 0)
+
+
+@pytest.mark.utils
+def test_git_runner_stall():
+    """
+    Test that only processes without progress are aborted, however long they run
+    """
+
+    runner = postrun.GitRunner(stall_timeout=0.5)
+    progress = 'import sys, time\nfor _ in range(6):\n    sys.stderr.write(\'.\\r\'); sys.stderr.flush(); time.sleep(0.2)'
+
+    started = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        runner.run([sys.executable, '-c', 'import time; time.sleep(10)'])
+    assert(time.monotonic() - started < 5)
+
+    assert(runner.run([sys.executable, '-c', progress + '\nprint("done")']) == b'done\n')
+
+
+@pytest.mark.utils
+def test_is_transient():
+    """
+    Test that network errors and stalls are retried, but not missing refs
+    """
+
+    assert(postrun.is_transient(subprocess.TimeoutExpired('git', 30)) == True)
+    assert(postrun.is_transient(subprocess.CalledProcessError(
+        128, 'git', stderr=b'fatal: unable to access: Could not resolve host: github.com')) == True)
+    assert(postrun.is_transient(subprocess.CalledProcessError(
+        128, 'git', stderr=b'fatal: Remote branch foobar not found in upstream origin')) == False)
+
+    for stderr in [b"fatal: unable to access 'https://github.com/x/y/': The requested URL returned error: 403",
+                   b"fatal: unable to access 'https://github.com/x/y/': The requested URL returned error: 404",
+                   b"fatal: unable to access 'https://git.example.com/y/': SSL certificate problem: certificate has expired",
+                   b"fatal: unable to access 'https://git.example.com/y/': server certificate verification failed"]:
+        assert(postrun.is_transient(subprocess.CalledProcessError(128, 'git', stderr=stderr)) == False)
+
+    for stderr in [b"fatal: unable to access 'https://github.com/x/y/': The requested URL returned error: 502",
+                   b"fatal: unable to access 'https://github.com/x/y/': The requested URL returned error: 429",
+                   b"fatal: unable to access 'https://github.com/x/y/': gnutls_handshake() failed: Error in the pull function.",
+                   b"fatal: unable to access 'https://github.com/x/y/': Failed to connect to github.com port 443"]:
+        assert(postrun.is_transient(subprocess.CalledProcessError(128, 'git', stderr=stderr)) == True)
+
+
+@pytest.mark.utils
+@mock.patch('time.sleep')
+def test_retry_policy(mock_sleep):
+    """
+    Test that transient failures are retried with backoff and counted
+    """
+
+    policy = postrun.RetryPolicy(retries=2, backoff=1.0)
+    error = subprocess.CalledProcessError(128, 'git', stderr=b'fatal: the remote end hung up unexpectedly')
+    func = mock.MagicMock(side_effect=[error, error, 'ok'])
+
+    policy.reset_count()
+    assert(policy.call('https://github.com/vision-it/puppet-roles.git', func, 'ls-remote') == 'ok')
+    assert(policy.count() == 2)
+    assert(func.call_count == 3)
+    assert(mock_sleep.call_count == 2)
+    assert(0 <= mock_sleep.call_args_list[1][0][0] <= 2.0)
+
+    func = mock.MagicMock(side_effect=subprocess.CalledProcessError(128, 'git', stderr=b'Repository not found'))
+    with pytest.raises(subprocess.CalledProcessError):
+        policy.call('https://github.com/vision-it/puppet-roles.git', func)
+    assert(func.call_count == 1)
+
+
+@pytest.mark.utils
+@mock.patch('time.sleep')
+def test_retry_policy_circuit_breaker(mock_sleep):
+    """
+    Test that a host fails fast after repeated transient failures until the cooldown passed
+    """
+
+    policy = postrun.RetryPolicy(retries=0, failures=2, cooldown=60)
+    func = mock.MagicMock(side_effect=subprocess.TimeoutExpired('git', 30))
+
+    for _ in range(2):
+        with pytest.raises(subprocess.TimeoutExpired):
+            policy.call('https://github.com/vision-it/puppet-roles.git', func)
+
+    with pytest.raises(postrun.HostUnavailable):
+        policy.call('https://github.com/vision-it/puppet-base.git', func)
+    assert(func.call_count == 2)
+    assert(policy.is_open('github.com') == True)
+    assert(policy.is_open('gitlab.com') == False)
+
+    policy.cooldown = 0
+    func.side_effect = None
+    policy.call('https://github.com/vision-it/puppet-base.git', func)
+    assert(policy.is_open('github.com') == False)
+
+
+@pytest.mark.utils
+@mock.patch('time.sleep')
+def test_clone_retry_after_stall(mock_sleep, git_repo, tmpdir):
+    """
+    Test that a clone killed by the stall timeout is retried into a clean target
+    """
+
+    mock_logger = mock.MagicMock()
+    url = 'file://' + str(git_repo)
+    run = postrun.GIT_RUNNER.run
+    stalled = []
+
+    def stall_once(cmd, *args, **kwargs):
+        if cmd[1] == 'clone' and cmd[-1] not in stalled:
+            stalled.append(cmd[-1])
+            os.makedirs(os.path.join(cmd[-1], '.git'))
+            raise subprocess.TimeoutExpired(cmd, 30)
+        return run(cmd, *args, **kwargs)
+
+    with mock.patch('postrun.GIT_RUNNER.run', side_effect=stall_once):
+        module = ('roles', {'url': url, 'ref': 'production'})
+        assert(postrun.clone_module(module, str(tmpdir.join('dist')), mock_logger) == True)
+
+        cache = postrun.MirrorCache(str(tmpdir.join('mirrors')), mock_logger)
+        assert(cache.update(url) == 'file://' + cache.path(url))
+
+    assert(len(stalled) == 2)
+    assert(tmpdir.join('dist', 'roles', 'metadata.json').check())
+    assert(os.path.isdir(os.path.join(cache.path(url), 'objects')))
+
+
+@pytest.mark.utils
+def test_retry_policy_permanent_errors():
+    """
+    Test that permanent errors of some repositories don't open the breaker for their host
+    """
+
+    policy = postrun.RetryPolicy(retries=2, failures=2)
+    error = subprocess.CalledProcessError(
+        128, 'git', stderr=b"fatal: unable to access 'https://github.com/x/y/': The requested URL returned error: 403")
+    func = mock.MagicMock(side_effect=error)
+
+    for _ in range(3):
+        with pytest.raises(subprocess.CalledProcessError):
+            policy.call('https://github.com/vision-it/puppet-private.git', func)
+
+    assert(func.call_count == 3)
+    assert(policy.is_open('github.com') == False)
+
+
+@pytest.mark.utils
+def test_scheduler_longest_first():
+    """
+    Test that collected jobs start longest first and their futures get the results
+    """
+
+    order = []
+    mock_logger = mock.MagicMock()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        scheduler = postrun.Scheduler(executor, mock_logger)
+        futures = [scheduler.submit(order.append, name, estimate=estimate)
+                   for name, estimate in [('small', 1.0), ('huge', 30.0), ('medium', 5.0)]]
+        assert(order == [])
+
+        scheduler.start()
+        late = scheduler.submit(order.append, 'late')
+        concurrent.futures.wait(futures + [late])
+
+    assert(order == ['huge', 'medium', 'small', 'late'])
+    mock_logger.debug.assert_any_call('Deploying 3 modules, estimated 36.0s')
+    mock_logger.debug.assert_any_call('4/4 jobs done, about 0.0s left')
+
+
+@pytest.mark.utils
+def test_job_history(tmpdir):
+    """
+    Test that durations are smoothed, persisted and used as estimate
+    """
+
+    history = postrun.JobHistory(str(tmpdir.join('durations.json')))
+    url = 'https://github.com/vision-it/puppet-roles.git'
+
+    assert(history.estimate(url, 'production') == 1.0)
+
+    history.record(url, 'production', duration=10.0, size=1024)
+    history.record(url, 'production', duration=20.0, size=2048)
+    history.record('https://github.com/vision-it/puppet-base.git', 'production', duration=5.0, size=0)
+    history.save()
+
+    history = postrun.JobHistory(str(tmpdir.join('durations.json')))
+    assert(history.estimate(url + '/', 'production') == 15.0)
+    assert(history.estimate(url, 'feature') == 10.0)
+
+
+@pytest.mark.utils
+def test_swap_directory_discard(tmpdir):
+    """
+    Test that the old directory is handed to the trash and deleted in the background
+    """
+
+    tmpdir.join('staging', 'roles', 'new').ensure(dir=True)
+    tmpdir.join('dist', 'roles', 'old').ensure(dir=True)
+    trash = postrun.Trash(str(tmpdir.join('discarded')))
+
+    postrun.swap_directory(str(tmpdir.join('staging', 'roles')),
+                           str(tmpdir.join('dist', 'roles')),
+                           str(tmpdir.join('trash')),
+                           discard=trash.discard)
+    trash.wait()
+
+    assert(os.listdir(str(tmpdir.join('dist', 'roles'))) == ['new'])
+    assert(os.listdir(str(tmpdir.join('trash'))) == [])
+    assert(os.listdir(str(tmpdir.join('discarded'))) == [])
+
+
+@pytest.mark.utils
+def test_create_logger_idempotent(tmpdir):
+    """
+    Test that setting up the logger again doesn't add handlers
+    """
+
+    log_file = str(tmpdir.join('postrun.log'))
+
+    try:
+        logger = postrun.create_logger(log_file=log_file)
+        handlers = list(logger.handlers)
+
+        assert(postrun.create_logger(log_file=log_file, verbose=True) is logger)
+        assert(logger.handlers == handlers)
+        assert(len(handlers) == 1)
+    finally:
+        postrun.stop_logging()
+
+    assert(logger.handlers == [])
+
+
+@pytest.mark.utils
+def test_create_logger_json(tmpdir):
+    """
+    Test that JSON lines contain the environment and module of the logging thread
+    """
+
+    log_file = tmpdir.join('postrun.log')
+
+    try:
+        logger = postrun.create_logger(log_file=str(log_file), json_lines=True)
+
+        with postrun.log_context(environment='production', module='roles'):
+            logger.error('Error while cloning %s', 'roles')
+        logger.error('Deployment failed')
+
+        try:
+            raise RuntimeError('git not found')
+        except RuntimeError:
+            logger.exception('Error while deploying')
+
+        postrun.flush_logs()
+    finally:
+        postrun.stop_logging()
+
+    first, second, third = [json.loads(line) for line in log_file.readlines()]
+    assert(first['message'] == 'Error while cloning roles')
+    assert((first['environment'], first['module'], first['level']) == ('production', 'roles', 'ERROR'))
+    assert('environment' not in second and 'module' not in second)
+    assert('exception' not in second)
+    assert(third['message'] == 'Error while deploying')
+    assert(third['exception'].startswith('Traceback') and 'RuntimeError: git not found' in third['exception'])
@@ -36,6 +36,7 @@ def test_ModulesLoader_no_modulesyaml(mock_isfile, mock_logger, capfd):
                               location='some_loc')
 
     ml.load_modules_file()
+    postrun.flush_logs()
     out, err = capfd.readouterr()
 
     assert(out == '[ERROR]: /tmp/staging/modules.yaml not found for staging\n')
@@ -53,9 +54,10 @@ def test_ModulesLoader_using_default(mock_isfile, mock_logger, capfd):
                               location='some_loc')
 
     ml.load_modules_file = mock.MagicMock()
-    ml.load_modules_file.return_value = {}
+    ml.load_modules_file.return_value = {'modules': {'default': {}}}
 
     ml.load_modules_from_yaml()
+    postrun.flush_logs()
     out, err = capfd.readouterr()
 
     assert(out == '[INFO]: configuration for location some_loc not found, using default\n')
@@ -76,6 +78,7 @@ def test_ModulesLoader_no_module(mock_logger, capfd):
                               location='default')
 
     ml.get_modules()
+    postrun.flush_logs()
     out, err = capfd.readouterr()
 
     assert(out == '[ERROR]: Module foobar not found in configuration\n')
@@ -84,7 +87,7 @@ def test_ModulesLoader_no_module(mock_logger, capfd):
 @pytest.mark.xfail
 @pytest.mark.verbose
 @mock.patch('postrun.git')
-def test_clone_module_fail_verbose(mock_git, mock_logger, capfd):
+def test_clone_module_fail_verbose(mock_git, mock_logger, capfd, tmpdir):
     """
     Test output with git error
     """
@@ -93,7 +96,8 @@ def test_clone_module_fail_verbose(mock_git, mock_logger, capfd):
     module = ('roles',
               {'url': 'https://github.com/vision-it/foobar.git', 'ref': 'notabranch'})
 
-    postrun.clone_module(module=module, target_directory='/tmp', logger=mock_logger)
+    postrun.clone_module(module=module, target_directory=str(tmpdir), logger=mock_logger)
+    postrun.flush_logs()
     out, err = capfd.readouterr()
 
     assert(out == '[ERROR]: Error while cloning roles\n')